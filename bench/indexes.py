@@ -0,0 +1,117 @@
+'''
+Compare lookup cost on a synthetic database before and after the index
+migration.
+
+    python bench/indexes.py --files 2000000
+'''
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from polytaxis_monitor import common
+
+
+def build(cursor, file_count, dir_size, tags_per_file):
+    # Unversioned (pre-migration) layout
+    cursor.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, parent INT, segment TEXT NOT NULL, tags TEXT)')
+    cursor.execute('CREATE TABLE tags (tag TEXT NOT NULL, file INT NOT NULL)')
+    cursor.execute(
+        'INSERT INTO files (id, parent, segment, tags) VALUES (1, NULL, \'/\', NULL)'
+    )
+    next_id = 2
+    dirs = []
+    files = []
+    tags = []
+    for index in range(file_count):
+        if index % dir_size == 0:
+            dir_id = next_id
+            next_id += 1
+            dirs.append((dir_id, 1, 'dir{}'.format(len(dirs)), None))
+        file_tags = [
+            'tag{}={}'.format(tag, random.randrange(1000))
+            for tag in range(tags_per_file)
+        ]
+        files.append((
+            next_id,
+            dir_id,
+            'file{}'.format(index),
+            ''.join(tag + '\n' for tag in file_tags),
+        ))
+        tags.extend((tag, next_id) for tag in file_tags)
+        next_id += 1
+    cursor.executemany(
+        'INSERT INTO files (id, parent, segment, tags) VALUES (?, ?, ?, ?)',
+        dirs + files,
+    )
+    cursor.executemany('INSERT INTO tags (tag, file) VALUES (?, ?)', tags)
+    return dirs, files
+
+
+def measure(name, cursor, statement, args):
+    start = time.perf_counter()
+    for arg in args:
+        cursor.execute(statement, arg).fetchall()
+    elapsed = time.perf_counter() - start
+    print('  {:<16} {:>10.3f} ms/lookup'.format(
+        name, elapsed * 1000 / len(args),
+    ))
+
+
+def run(cursor, dirs, files, lookups):
+    sample = random.sample(files, lookups)
+    measure(
+        'get_fid',
+        cursor,
+        'SELECT id FROM files WHERE parent is :parent AND segment = :segment LIMIT 1',
+        [{'parent': row[1], 'segment': row[2]} for row in sample],
+    )
+    measure(
+        'tag query',
+        cursor,
+        'SELECT file FROM tags WHERE tag = :tag',
+        [{'tag': 'tag0={}'.format(random.randrange(1000))} for _ in sample],
+    )
+    measure(
+        'tags by file',
+        cursor,
+        'SELECT tag FROM tags WHERE file = :fid',
+        [{'fid': row[0]} for row in sample],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000000)
+    parser.add_argument('--dir_size', type=int, default=1000)
+    parser.add_argument('--tags_per_file', type=int, default=3)
+    parser.add_argument('--lookups', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        conn = sqlite3.connect(os.path.join(root, 'bench.sqlite3'))
+        cursor = conn.cursor()
+        print('Building {} files...'.format(args.files))
+        dirs, files = build(
+            cursor, args.files, args.dir_size, args.tags_per_file
+        )
+        conn.commit()
+
+        print('Before migration:')
+        run(cursor, dirs, files, args.lookups)
+
+        start = time.perf_counter()
+        # Only the index migration; later ones change the tags layout
+        common._migrate_indexes(cursor)
+        conn.commit()
+        print('Migration took {:.1f} s'.format(time.perf_counter() - start))
+
+        print('After migration:')
+        run(cursor, dirs, files, args.lookups)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
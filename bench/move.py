@@ -0,0 +1,59 @@
+'''
+Time moving a large indexed directory with move_file.
+
+    python bench/move.py --files 100000
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from polytaxis_monitor import common
+import polytaxis_monitor.main
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--dir_size', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        conn, cursor = common.open_db(
+            db_path=os.path.join(root, 'bench.sqlite3')
+        )
+        polytaxis_monitor.main.conn = conn
+        polytaxis_monitor.main.cursor = cursor
+
+        print('Building {} files...'.format(args.files))
+        ingest = polytaxis_monitor.main.Ingest(batch_size=10000)
+        for index in range(args.files):
+            if index % args.dir_size == 0:
+                parent, children = ingest.directory(
+                    '/library/photos/{}'.format(index // args.dir_size)
+                )
+            ingest.apply(
+                parent,
+                children,
+                '/library/photos/{}/{}.jpg'.format(
+                    index // args.dir_size, index,
+                ),
+                (index, index, index),
+                {'camera': {'x{}'.format(index % 10)}},
+            )
+        ingest.finish()
+
+        start = time.perf_counter()
+        polytaxis_monitor.main.move_file(
+            '/library/photos', '/library/archive/photos'
+        )
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        moved = cursor.execute(
+            'SELECT count(1) FROM paths WHERE path LIKE \'/library/archive/photos/%\''
+        ).fetchone()[0]
+        print('Moved {} entries in {:.3f} s'.format(moved, elapsed))
+
+
+if __name__ == '__main__':
+    main()
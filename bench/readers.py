@@ -0,0 +1,136 @@
+'''
+Run a writer that behaves like the monitor (long group-commit transactions)
+alongside concurrent QueryDB readers, and report read latency percentiles.
+
+    python bench/readers.py --readers 8 --journal_mode wal
+    python bench/readers.py --readers 8 --journal_mode delete
+'''
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from polytaxis_monitor import common
+from polytaxis_monitor import options
+import polytaxis_monitor.main
+
+
+def populate(db_path, file_count, db_options):
+    conn, cursor = common.open_db(db_path=db_path, **db_options)
+    polytaxis_monitor.main.conn = conn
+    polytaxis_monitor.main.cursor = cursor
+    for index in range(file_count):
+        tags = {
+            'album': {'album{}'.format(index % 100)},
+            'track': {str(index % 20)},
+        }
+        fid = polytaxis_monitor.main.create_file(
+            '/music/album{}/track{}.flac'.format(index % 100, index), tags,
+        )
+        polytaxis_monitor.main.add_tags(fid, tags)
+    conn.commit()
+    return conn, cursor
+
+
+def write(conn, file_count, commit_latency, stop, stats):
+    # Modify random files, holding each transaction open for commit_latency
+    # like the monitor's commit scheduler does
+    while not stop.is_set():
+        started = time.monotonic()
+        while time.monotonic() - started < commit_latency:
+            index = random.randrange(file_count)
+            tags = {
+                'album': {'album{}'.format(index % 100)},
+                'track': {str(random.randrange(20))},
+            }
+            fid = polytaxis_monitor.main.create_file(
+                '/music/album{}/track{}.flac'.format(index % 100, index),
+                tags,
+            )
+            polytaxis_monitor.main.update_file(fid, tags)
+            polytaxis_monitor.main.remove_tags(fid)
+            polytaxis_monitor.main.add_tags(fid, tags)
+            stats['writes'] += 1
+            time.sleep(0.001)
+        conn.commit()
+        stats['commits'] += 1
+
+
+def read(db_path, db_options, stop, latencies, errors):
+    db = common.QueryDB(db_path=db_path, **db_options)
+    while not stop.is_set():
+        include = ['album=album{}'.format(random.randrange(100))]
+        started = time.monotonic()
+        try:
+            for row in db.query(include, [], add_path=True):
+                pass
+        except sqlite3.OperationalError:
+            errors.append(time.monotonic() - started)
+            continue
+        latencies.append(time.monotonic() - started)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--commit_latency', type=float, default=5)
+    options.add_db_arguments(parser)
+    args = parser.parse_args()
+    db_options = options.db_options(args)
+
+    with tempfile.TemporaryDirectory() as root:
+        db_path = os.path.join(root, 'bench.sqlite3')
+        print('Building {} files...'.format(args.files))
+        conn, cursor = populate(db_path, args.files, db_options)
+
+        stop = threading.Event()
+        stats = {'writes': 0, 'commits': 0}
+        latencies = []
+        errors = []
+        threads = [threading.Thread(
+            target=write,
+            args=(conn, args.files, args.commit_latency, stop, stats),
+        )]
+        threads.extend(
+            threading.Thread(
+                target=read,
+                args=(db_path, db_options, stop, latencies, errors),
+            )
+            for _ in range(args.readers)
+        )
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        latencies.sort()
+        print('Journal mode {}: {} writes in {} commits'.format(
+            args.journal_mode, stats['writes'], stats['commits'],
+        ))
+        print('{} queries, {} failed (database is locked)'.format(
+            len(latencies) + len(errors), len(errors),
+        ))
+        if latencies:
+            for name, fraction in [
+                    ('p50', 0.5),
+                    ('p90', 0.9),
+                    ('p99', 0.99),
+                    ('max', 1)]:
+                print('  {} {:>10.2f} ms'.format(
+                    name, percentile(latencies, fraction) * 1000,
+                ))
+
+
+if __name__ == '__main__':
+    main()
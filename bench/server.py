@@ -0,0 +1,103 @@
+'''
+Compare per-query latency of ptq run directly, ptq --server, and a
+long-lived client talking to the query server.
+
+    python bench/server.py --files 20000 --queries 50
+'''
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def timed(name, queries, run):
+    start = time.perf_counter()
+    for query in queries:
+        run(query)
+    elapsed = time.perf_counter() - start
+    print('  {:<16} {:>10.2f} ms/query'.format(
+        name, elapsed * 1000 / len(queries),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        # ptq only knows the default database location, so point the data
+        # directory somewhere disposable before anything computes it
+        os.environ['XDG_DATA_HOME'] = root
+        from polytaxis_monitor import common
+        from polytaxis_monitor import client as server_client
+        from polytaxis_monitor import server
+        import polytaxis_monitor.main
+
+        conn, cursor = common.open_db()
+        polytaxis_monitor.main.conn = conn
+        polytaxis_monitor.main.cursor = cursor
+        print('Building {} files...'.format(args.files))
+        ingest = polytaxis_monitor.main.Ingest(batch_size=10000)
+        for index in range(args.files):
+            if index % 100 == 0:
+                parent, children = ingest.directory(
+                    '/music/album{}'.format(index // 100)
+                )
+            ingest.apply(
+                parent,
+                children,
+                '/music/album{}/{}.flac'.format(index // 100, index),
+                (index, index, index),
+                {
+                    'album': {'album{}'.format(index // 100)},
+                    'rating': {str(index % 5)},
+                },
+            )
+        ingest.finish()
+        conn.close()
+
+        queries = [
+            ['album=album{}'.format(random.randrange(args.files // 100))]
+            for _ in range(args.queries)
+        ]
+        query_server = server.QueryServer()
+        query_server.start()
+        ptq = [sys.executable, '-m', 'ptq.main']
+
+        def direct(query):
+            subprocess.run(ptq + query, stdout=subprocess.DEVNULL, check=True)
+
+        def via_server(query):
+            subprocess.run(
+                ptq + ['--server'] + query,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+
+        client = server_client.Client()
+
+        def client_call(query):
+            list(client.call('search', args=query, limit=1000, add_path=True))
+
+        db = common.QueryDB()
+
+        def in_process(query):
+            list(server.search(db, query, 1000, add_path=True))
+
+        try:
+            timed('ptq', queries, direct)
+            timed('ptq --server', queries, via_server)
+            timed('client', queries, client_call)
+            timed('in process', queries, in_process)
+        finally:
+            client.close()
+            query_server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Time `ptq -t anywhere` style tag searches against many distinct tags, with
+and without the trigram index.
+
+    python bench/tag_search.py --tags 1000000
+'''
+import argparse
+import itertools
+import os
+import random
+import string
+import tempfile
+import time
+
+from polytaxis_monitor import common
+import polytaxis_monitor.main
+
+
+def word():
+    return ''.join(
+        random.choice(string.ascii_lowercase)
+        for _ in range(random.randrange(4, 10))
+    )
+
+
+def build(tag_count):
+    keys = ['album', 'artist', 'title', 'composer', 'label', 'genre']
+    tags = set()
+    while len(tags) < tag_count:
+        tags.add('{}={} {}'.format(random.choice(keys), word(), word()))
+    tags = sorted(tags)
+    # One file per tag keeps every name in use
+    polytaxis_monitor.main.insert_tag_rows(
+        (tag, index) for index, tag in enumerate(tags, 1)
+    )
+    return tags
+
+
+def measure(name, db, args, results):
+    start = time.perf_counter()
+    count = 0
+    for arg in args:
+        # The first screenful, like autocompletion
+        count += len(list(itertools.islice(
+            db.query_tags('anywhere', arg), results,
+        )))
+    elapsed = time.perf_counter() - start
+    print('  {:<16} {:>10.3f} ms/search ({} results)'.format(
+        name, elapsed * 1000 / len(args), count,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tags', type=int, default=1000000)
+    parser.add_argument('--searches', type=int, default=50)
+    parser.add_argument('--results', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        db_path = os.path.join(root, 'bench.sqlite3')
+        conn, cursor = common.open_db(db_path=db_path)
+        polytaxis_monitor.main.conn = conn
+        polytaxis_monitor.main.cursor = cursor
+        print('Building {} tags...'.format(args.tags))
+        start = time.perf_counter()
+        tags = build(args.tags)
+        conn.commit()
+        print('Built in {:.1f} s'.format(time.perf_counter() - start))
+
+        # Substrings of real tags, as typed into a search box
+        searches = []
+        for tag in random.sample(tags, args.searches):
+            value = tag.split('=', 1)[1]
+            offset = random.randrange(len(value) - 3)
+            searches.append(value[offset:offset + random.randrange(3, 6)])
+
+        db = common.QueryDB(db_path=db_path)
+        for tag_search in (False, True):
+            db.tag_search = tag_search
+            measure(
+                'trigram index' if tag_search else 'scan',
+                db,
+                searches,
+                args.results,
+            )
+
+
+if __name__ == '__main__':
+    main()
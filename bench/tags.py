@@ -0,0 +1,165 @@
+'''
+Compare database size and tag lookup latency before and after interning tag
+names, on a music-library-like corpus where long tags repeat across many
+files.
+
+    python bench/tags.py --files 500000
+'''
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from polytaxis_monitor import common
+
+
+def build(cursor, file_count, album_size):
+    cursor.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, parent INT, segment TEXT NOT NULL, tags TEXT)')
+    cursor.execute('CREATE TABLE tags (tag TEXT NOT NULL, file INT NOT NULL)')
+    # Bring the schema up to just before the tag dictionary
+    common.schema_version(cursor)
+    for index, migration in enumerate(
+            common.migrations[:common.migrations.index(common._migrate_tag_names)]):
+        migration(cursor)
+        cursor.execute(
+            'UPDATE schema_version SET version = :version',
+            {'version': index + 1},
+        )
+    cursor.execute(
+        'INSERT INTO files (id, parent, segment) VALUES (1, NULL, \'/\')'
+    )
+    cursor.execute('INSERT INTO paths (file, path) VALUES (1, \'/\')')
+    files = []
+    paths = []
+    tags = []
+    next_id = 2
+    albums = []
+    for index in range(file_count):
+        if index % album_size == 0:
+            album = 'The Complete Recordings of Ensemble Number {}'.format(
+                len(albums)
+            )
+            artist = 'Some Reasonably Long Artist Name {}'.format(
+                len(albums) % 300
+            )
+            albums.append(album)
+            dir_id = next_id
+            next_id += 1
+            files.append((dir_id, 1, album, None))
+            paths.append((dir_id, '/' + album))
+        file_tags = [
+            'album={}'.format(album),
+            'artist={}'.format(artist),
+            'genre=genre{}'.format(len(albums) % 40),
+            'year={}'.format(1950 + len(albums) % 70),
+            'track={}'.format(index % album_size),
+            'title=Track {} of {}'.format(index % album_size, album),
+        ]
+        segment = '{}.flac'.format(index)
+        files.append((
+            next_id,
+            dir_id,
+            segment,
+            ''.join(tag + '\n' for tag in file_tags),
+        ))
+        paths.append((next_id, '/{}/{}'.format(album, segment)))
+        tags.extend((tag, next_id) for tag in file_tags)
+        next_id += 1
+    cursor.executemany(
+        'INSERT INTO files (id, parent, segment, tags) VALUES (?, ?, ?, ?)',
+        files,
+    )
+    cursor.executemany('INSERT INTO paths (file, path) VALUES (?, ?)', paths)
+    cursor.executemany('INSERT INTO tags (tag, file) VALUES (?, ?)', tags)
+    return albums
+
+
+def size(conn):
+    conn.execute('VACUUM')
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    return page_size * page_count
+
+
+def measure(name, cursor, statement, args):
+    start = time.perf_counter()
+    count = 0
+    for arg in args:
+        count += len(cursor.execute(statement, arg).fetchall())
+    elapsed = time.perf_counter() - start
+    print('  {:<16} {:>10.3f} ms/query ({} rows)'.format(
+        name, elapsed * 1000 / len(args), count,
+    ))
+
+
+# The query QueryDB.query builds for a single include, for each layout
+old_select = (
+    'SELECT files.id, files.segment, files.tags FROM files WHERE files.id IN '
+    '(SELECT DISTINCT file FROM tags WHERE tag {} :tag)'
+)
+new_select = (
+    'SELECT files.id, files.segment, files.tags FROM files WHERE files.id IN '
+    '(SELECT DISTINCT file FROM file_tags WHERE tag IN '
+    '(SELECT id FROM tag_names WHERE tag {} :tag))'
+)
+
+
+def samples(albums, lookups):
+    # Both layouts are timed on the same lookups
+    return (
+        random.sample(albums, min(lookups, len(albums))),
+        [random.randrange(300) for _ in range(lookups)],
+    )
+
+
+def run(cursor, select, albums, artists):
+    measure(
+        'album',
+        cursor,
+        select.format('='),
+        [{'tag': 'album={}'.format(album)} for album in albums],
+    )
+    measure(
+        'artist prefix',
+        cursor,
+        select.format('LIKE'),
+        [
+            {'tag': 'artist=Some Reasonably Long Artist Name {}%'.format(
+                artist
+            )}
+            for artist in artists
+        ],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=500000)
+    parser.add_argument('--album_size', type=int, default=12)
+    parser.add_argument('--lookups', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        conn = sqlite3.connect(os.path.join(root, 'bench.sqlite3'))
+        cursor = conn.cursor()
+        print('Building {} files...'.format(args.files))
+        albums = build(cursor, args.files, args.album_size)
+        conn.commit()
+        sample_albums, sample_artists = samples(albums, args.lookups)
+        print('Before interning: {:.1f} MiB'.format(size(conn) / 1024 ** 2))
+        run(cursor, old_select, sample_albums, sample_artists)
+
+        start = time.perf_counter()
+        # Only the tag dictionary; later migrations change the layout again
+        common._migrate_tag_names(cursor)
+        conn.commit()
+        print('Migration took {:.1f} s'.format(time.perf_counter() - start))
+        print('After interning: {:.1f} MiB'.format(size(conn) / 1024 ** 2))
+        run(cursor, new_select, sample_albums, sample_artists)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
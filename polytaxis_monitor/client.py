@@ -0,0 +1,59 @@
+# The client side of the query server.  This only needs the standard library
+# so that programs talking to a server start quickly.
+import os
+import json
+import socket
+
+from polytaxis_monitor.row import Row
+
+
+def default_socket_path():
+    import appdirs
+    root = appdirs.user_data_dir('polytaxis-monitor', 'zarbosoft')
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, 'query.sock')
+
+
+class ServerError(Exception):
+    pass
+
+
+def _decode(result):
+    if isinstance(result, dict):
+        return Row(
+            result['fid'],
+            result['segment'],
+            tags={
+                key: set(values) for key, values in result['tags'].items()
+            },
+            path=result['path'],
+        )
+    return result
+
+
+class Client(object):
+    '''A connection to a QueryServer.'''
+    def __init__(self, path=None):
+        if path is None:
+            path = default_socket_path()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+
+    def call(self, name, /, **params):
+        '''Yield the results of a request; they must all be read.'''
+        params['request'] = name
+        self.file.write(json.dumps(params).encode('utf-8') + b'\n')
+        self.file.flush()
+        for line in self.file:
+            response = json.loads(line.decode('utf-8'))
+            if 'error' in response:
+                raise ServerError(response['error'])
+            if response.get('done'):
+                return
+            yield _decode(response['result'])
+        raise ServerError('Server closed the connection')
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
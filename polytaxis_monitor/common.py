@@ -2,15 +2,22 @@ import errno
 import os
 import sqlite3
 import functools
+import heapq
 import random
 import hashlib
 import operator
 import ntpath
+import collections
+import itertools
+import json
 
 import appdirs
 import polytaxis
 import natsort
 
+from polytaxis_monitor.options import journal_modes, synchronous_modes
+from polytaxis_monitor.row import Row
+
 verbose = False
 
 _natkey = natsort.natsort_keygen()
@@ -55,24 +62,270 @@ def mkdir_p(path):
         else: raise
 
 
+def _migrate_indexes(cursor):
+    cursor.execute('CREATE INDEX files_parent_segment ON files (parent, segment)')
+    cursor.execute('CREATE INDEX tags_tag_file ON tags (tag, file)')
+    cursor.execute('CREATE INDEX tags_file ON tags (file)')
+
+
+def _migrate_paths(cursor):
+    cursor.execute('CREATE TABLE paths (file INTEGER PRIMARY KEY, path TEXT NOT NULL)')
+    cursor.execute('CREATE INDEX paths_path ON paths (path)')
+    paths = {}
+    rows = []
+    # Parents are always produced before their children
+    for fid, parent, segment in cursor.execute(
+            'WITH RECURSIVE tree(id, parent, segment) AS ('
+            'SELECT id, parent, segment FROM files WHERE parent IS NULL '
+            'UNION ALL '
+            'SELECT files.id, files.parent, files.segment FROM files '
+            'JOIN tree ON files.parent = tree.id'
+            ') SELECT id, parent, segment FROM tree'
+            ).fetchall():
+        paths[fid] = join_path(paths.get(parent), segment)
+        rows.append((fid, paths[fid]))
+    cursor.executemany('INSERT INTO paths (file, path) VALUES (?, ?)', rows)
+
+
+def _migrate_stats(cursor):
+    cursor.execute('ALTER TABLE files ADD COLUMN mtime INT')
+    cursor.execute('ALTER TABLE files ADD COLUMN size INT')
+    cursor.execute('ALTER TABLE files ADD COLUMN inode INT')
+
+
+def _migrate_tag_names(cursor):
+    # Store each distinct tag once and refer to it by id
+    cursor.execute('CREATE TABLE tag_names (id INTEGER PRIMARY KEY, tag TEXT NOT NULL UNIQUE)')
+    cursor.execute('INSERT INTO tag_names (tag) SELECT DISTINCT tag FROM tags ORDER BY tag')
+    cursor.execute(
+        'CREATE TABLE file_tags ('
+        'tag INT NOT NULL, file INT NOT NULL, PRIMARY KEY (tag, file)'
+        ') WITHOUT ROWID'
+    )
+    cursor.execute(
+        'INSERT OR IGNORE INTO file_tags (tag, file) '
+        'SELECT tag_names.id, tags.file FROM tags '
+        'JOIN tag_names ON tag_names.tag = tags.tag'
+    )
+    cursor.execute('CREATE INDEX file_tags_file ON file_tags (file)')
+    cursor.execute('DROP TABLE tags')
+
+
+def _migrate_tag_keys(cursor):
+    # Split names into key and value, with an order-preserving natural sort
+    # key for the value, so range filters can be answered by an index
+    cursor.execute('ALTER TABLE tag_names ADD COLUMN key TEXT')
+    cursor.execute('ALTER TABLE tag_names ADD COLUMN value TEXT')
+    cursor.execute('ALTER TABLE tag_names ADD COLUMN sort_key BLOB')
+    cursor.executemany(
+        'UPDATE tag_names SET key = ?2, value = ?3, sort_key = ?4 WHERE tag = ?1',
+        [
+            tag_columns(tag) for (tag,) in
+            cursor.execute('SELECT tag FROM tag_names').fetchall()
+        ],
+    )
+    cursor.execute('CREATE INDEX tag_names_key_sort ON tag_names (key, sort_key)')
+    # LIKE is case insensitive, so it can only use a NOCASE index for prefixes
+    cursor.execute('CREATE INDEX tag_names_tag_nocase ON tag_names (tag COLLATE NOCASE)')
+
+
+def _migrate_tag_search(cursor):
+    # A trigram index over tag names for substring searches.  FTS5 and the
+    # trigram tokenizer are optional in SQLite builds; without them
+    # query_tags falls back to scanning.
+    try:
+        cursor.execute(
+            'CREATE VIRTUAL TABLE tag_names_fts USING fts5('
+            'tag, content=\'tag_names\', content_rowid=\'id\', '
+            'tokenize=\'trigram\')'
+        )
+    except sqlite3.OperationalError as e:
+        if verbose:
+            print('Not creating tag search index: {}'.format(e))
+        return
+    cursor.execute(
+        'INSERT INTO tag_names_fts (tag_names_fts) VALUES (\'rebuild\')'
+    )
+    cursor.execute(
+        'CREATE TRIGGER tag_names_fts_insert AFTER INSERT ON tag_names BEGIN '
+        'INSERT INTO tag_names_fts (rowid, tag) VALUES (new.id, new.tag); '
+        'END'
+    )
+    cursor.execute(
+        'CREATE TRIGGER tag_names_fts_delete AFTER DELETE ON tag_names BEGIN '
+        'INSERT INTO tag_names_fts (tag_names_fts, rowid, tag) '
+        'VALUES (\'delete\', old.id, old.tag); '
+        'END'
+    )
+    cursor.execute(
+        'CREATE TRIGGER tag_names_fts_update AFTER UPDATE OF tag ON tag_names BEGIN '
+        'INSERT INTO tag_names_fts (tag_names_fts, rowid, tag) '
+        'VALUES (\'delete\', old.id, old.tag); '
+        'INSERT INTO tag_names_fts (rowid, tag) VALUES (new.id, new.tag); '
+        'END'
+    )
+
+
+def _migrate_tag_counts(cursor):
+    # How many files have each tag, kept current by triggers on file_tags
+    cursor.execute('ALTER TABLE tag_names ADD COLUMN count INT NOT NULL DEFAULT 0')
+    cursor.execute(
+        'UPDATE tag_names SET count = '
+        '(SELECT count(1) FROM file_tags WHERE file_tags.tag = tag_names.id)'
+    )
+    cursor.execute(
+        'CREATE TRIGGER file_tags_count_insert AFTER INSERT ON file_tags BEGIN '
+        'UPDATE tag_names SET count = count + 1 WHERE id = new.tag; '
+        'END'
+    )
+    cursor.execute(
+        'CREATE TRIGGER file_tags_count_delete AFTER DELETE ON file_tags BEGIN '
+        'UPDATE tag_names SET count = count - 1 WHERE id = old.tag; '
+        'END'
+    )
+
+
+def has_table(cursor, name):
+    return cursor.execute(
+        'SELECT 1 FROM sqlite_master WHERE name = :name',
+        {
+            'name': name,
+        },
+    ).fetchone() is not None
+
+
+# Migration N brings the schema from version N to version N + 1.  Only ever
+# append to this list.
+migrations = [
+    _migrate_indexes,
+    _migrate_paths,
+    _migrate_stats,
+    _migrate_tag_names,
+    _migrate_tag_keys,
+    _migrate_tag_search,
+    _migrate_tag_counts,
+]
+
+
+def schema_version(cursor):
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL)'
+    )
+    got = cursor.execute('SELECT version FROM schema_version').fetchone()
+    if got is None:
+        cursor.execute('INSERT INTO schema_version (version) VALUES (0)')
+        return 0
+    return got[0]
+
+
+def migrate_db(cursor):
+    connection = getattr(cursor, 'connection', cursor)
+    version = schema_version(cursor)
+    for index, migration in enumerate(migrations[version:], version):
+        if verbose:
+            print('Migrating db to version {}'.format(index + 1))
+        # sqlite3 autocommits DDL outside of a transaction, so run each
+        # migration and its version bump in one explicitly.  Otherwise an
+        # interrupted upgrade leaves a schema no migration can continue from.
+        if connection.in_transaction:
+            connection.commit()
+        cursor.execute('BEGIN')
+        try:
+            migration(cursor)
+            cursor.execute(
+                'UPDATE schema_version SET version = :version',
+                {
+                    'version': index + 1,
+                },
+            )
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+
+def join_path(parent_path, segment):
+    if parent_path is None:
+        return segment
+    return os.path.join(parent_path, segment)
+
+
+def path_prefix_range(path):
+    # Bounds of the paths of everything beneath path, for use with the path
+    # index
+    prefix = os.path.join(path, '')
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def natural_sort_key(value):
+    '''
+    Encode the natsort key of value as bytes that compare (as a SQLite blob)
+    in the same order as the natsort keys themselves.
+    '''
+    out = []
+    for part in _natkey(value):
+        if isinstance(part, int):
+            digits = part.to_bytes((part.bit_length() + 7) // 8, 'big')
+            out.append(b'\x01' + bytes([len(digits)]) + digits)
+        else:
+            out.append(
+                b'\x02' +
+                part.encode('utf-8').replace(b'\x00', b'\x00\xff') +
+                b'\x00\x01'
+            )
+    return b''.join(out)
+
+
+def tag_columns(tag):
+    '''Return the tag_names (tag, key, value, sort_key) for an encoded tag.'''
+    key, values = next(iter(
+        polytaxis.decode_tags((tag + '\n').encode('utf-8')).items()
+    ))
+    value = next(iter(values))
+    return (
+        tag,
+        key,
+        value,
+        None if value is None else natural_sort_key(value),
+    )
+
+
 def init_db(cursor):
     cursor.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, parent INT, segment TEXT NOT NULL, tags TEXT)')
     cursor.execute('CREATE TABLE tags (tag TEXT NOT NULL, file INT NOT NULL)')
+    migrate_db(cursor)
+
+
+def open_db(
+        db_path=None,
+        journal_mode='wal',
+        synchronous='normal',
+        cache_size=-65536,
+        mmap_size=256 * 1024 * 1024):
+    if db_path is None:
+        root = appdirs.user_data_dir('polytaxis-monitor', 'zarbosoft')
+        mkdir_p(root)
+        db_path = os.path.join(root, 'db.sqlite3')
+    if journal_mode not in journal_modes:
+        raise ValueError('Unknown journal mode [{}]'.format(journal_mode))
+    if synchronous not in synchronous_modes:
+        raise ValueError('Unknown synchronous mode [{}]'.format(synchronous))
 
-
-def open_db():
-    root = appdirs.user_data_dir('polytaxis-monitor', 'zarbosoft')
-    mkdir_p(root)
-
-    db_path = os.path.join(root, 'db.sqlite3')
     do_init_db = False
     if not os.path.exists(db_path):
         print('Initializing db at [{}]'.format(db_path))
         do_init_db = True
     conn = sqlite3.connect(db_path, check_same_thread=False)
     cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+    cursor.execute('PRAGMA synchronous = {}'.format(synchronous))
+    cursor.execute('PRAGMA cache_size = {:d}'.format(cache_size))
+    cursor.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
     if do_init_db:
         init_db(cursor)
+    else:
+        migrate_db(cursor)
+    conn.commit()
     return conn, cursor
 
 
@@ -95,7 +348,7 @@ def parse_query(args):
             continue
         sort_asc = _shifttext(item, 'sort+:')
         if sort_asc:
-            if sort_desc not in columns:
+            if sort_asc not in columns:
                 columns.append(sort_asc)
             sort.append(('asc', sort_asc))
             continue
@@ -149,128 +402,389 @@ def parse_query(args):
     return includes, excludes, filters, sort, columns
 
 
+filter_operators = {
+    operator.lt: '<',
+    operator.le: '<=',
+    operator.gt: '>',
+    operator.ge: '>=',
+}
+
+
+_Term = collections.namedtuple(
+    '_Term', ['text', 'estimate', 'scan', 'probe'],
+)
+
+
 class QueryDB(object):
-    def __init__(self):
-        conn, self.cursor = open_db()
+    def __init__(
+            self, result_cache_size=64, result_cache_rows=10000,
+            **db_options):
+        '''
+        Results of up to result_cache_size queries with at most
+        result_cache_rows rows each are kept until the database changes.
+        '''
+        self.conn, self.cursor = open_db(**db_options)
+        self.tag_search = has_table(self.cursor, 'tag_names_fts')
+        self.result_cache_size = result_cache_size
+        self.result_cache_rows = result_cache_rows
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
     def clear_cache(self):
-        self._query_path_element.cache_clear()
+        self.results.clear()
+
+    def cache_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'entries': len(self.results),
+        }
 
-    @functools.lru_cache()
-    def _query_path_element(self, fid):
+    def _generation(self):
+        # data_version changes when other connections (the monitor) commit,
+        # total_changes when this one writes
+        return (
+            self.cursor.execute('PRAGMA data_version').fetchone()[0],
+            self.conn.total_changes,
+        )
+
+    def query_path(self, fid):
         return self.cursor.execute(
-            'SELECT parent, segment FROM files WHERE id = :id LIMIT 1',
+            'SELECT path FROM paths WHERE file = :id',
             {
                 'id': fid,
             },
-        ).fetchone()
-
-    def query_path(self, fid):
-        segments = []
-        while fid is not None:
-            fid, segment = self._query_path_element(fid)
-            segments.append(segment)
-        return os.path.join(*reversed(segments))
-
-    def query(self, include, exclude, add_path=False):
-        # Assemble includes/excludes into a sql query
-        query_include = []
-        query_exclude = []
-        query_args = {
-        }
-        query_index = [0]
-
-        def build_select(dest, item):
+        ).fetchone()[0]
+
+    def query_paths(self, fids, batch_size=500):
+        # Batched to stay under older SQLite builds' limit of 999 bound
+        # variables
+        fids = list(fids)
+        paths = {}
+        for start in range(0, len(fids), batch_size):
+            batch = fids[start:start + batch_size]
+            paths.update(self.cursor.execute(
+                'SELECT file, path FROM paths WHERE file IN ({})'.format(
+                    ', '.join('?' * len(batch))
+                ),
+                batch,
+            ))
+        return paths
+
+    def _terms(self, items, filters, query_args, index):
+        '''
+        Make a _Term for each tag pattern and range filter, estimating the
+        files each matches from the maintained tag counts.  Probes test the
+        file candidates.file.
+        '''
+        terms = []
+        for item in items:
+            name = 'tag{}'.format(next(index))
             if '%' in item:
-                dest.append(
-                    'SELECT file FROM tags WHERE tag LIKE :tag{}'.format(
-                        query_index[0]
-                    )
-                )
+                query_args[name] = item
+                # An upper bound, files with several matching tags count
+                # more than once
+                estimate = self.cursor.execute(
+                    'SELECT coalesce(sum(count), 0) FROM tag_names WHERE tag LIKE :tag',
+                    {
+                        'tag': item,
+                    },
+                ).fetchone()[0]
+                terms.append(_Term(
+                    item,
+                    estimate,
+                    'SELECT DISTINCT file FROM file_tags WHERE tag IN '
+                    '(SELECT id FROM tag_names WHERE tag LIKE :{})'.format(name),
+                    'EXISTS (SELECT 1 FROM file_tags '
+                    'JOIN tag_names ON tag_names.id = file_tags.tag '
+                    'WHERE file_tags.file = candidates.file AND '
+                    'tag_names.tag LIKE :{})'.format(name),
+                ))
             else:
-                dest.append(
-                    'SELECT file FROM tags WHERE tag = :tag{}'.format(
-                        query_index[0]
-                    )
+                # Look the id up now so the query uses it directly
+                got = self.cursor.execute(
+                    'SELECT id, count FROM tag_names WHERE tag = :tag',
+                    {
+                        'tag': item,
+                    },
+                ).fetchone()
+                tag_id, estimate = got if got is not None else (None, 0)
+                query_args[name] = tag_id
+                terms.append(_Term(
+                    item,
+                    estimate,
+                    'SELECT file FROM file_tags WHERE tag = :{}'.format(name),
+                    'EXISTS (SELECT 1 FROM file_tags WHERE tag = :{} AND '
+                    'file = candidates.file)'.format(name),
+                ))
+        # Range filters compare natural sort keys in the tag_names index; a
+        # file matches if any of its values for the key does
+        for comp, key, value in filters:
+            number = next(index)
+            key_name = 'key{}'.format(number)
+            sort_name = 'sort{}'.format(number)
+            query_args[key_name] = key
+            query_args[sort_name] = natural_sort_key(value)
+            condition = 'key = :{} AND sort_key {} :{}'.format(
+                key_name, filter_operators[comp], sort_name,
+            )
+            estimate = self.cursor.execute(
+                'SELECT coalesce(sum(count), 0) FROM tag_names WHERE ' +
+                condition,
+                query_args,
+            ).fetchone()[0]
+            terms.append(_Term(
+                '{}{}{}'.format(key, filter_operators[comp], value),
+                estimate,
+                'SELECT DISTINCT file FROM file_tags WHERE tag IN '
+                '(SELECT id FROM tag_names WHERE {})'.format(condition),
+                'EXISTS (SELECT 1 FROM file_tags '
+                'JOIN tag_names ON tag_names.id = file_tags.tag '
+                'WHERE file_tags.file = candidates.file AND {})'.format(
+                    condition
+                ),
+            ))
+        return terms
+
+    def _plan(self, include, exclude, filters):
+        '''
+        Choose how to run a query: scan the files of the most selective
+        include term, then probe each candidate for the other include terms
+        (most selective first, to reject early) and the exclude terms (most
+        common first).  Returns the term to scan (None to scan every tagged
+        file), the include probes, the exclude probes and the arguments.
+        '''
+        # parse_query also includes KEY=% for each filter, which the filter
+        # already implies
+        implied = {'{}=%'.format(key) for comp, key, value in filters}
+        include = [item for item in include if item not in implied]
+        query_args = {}
+        index = itertools.count()
+        estimate = operator.attrgetter('estimate')
+        includes = sorted(
+            self._terms(include, filters, query_args, index), key=estimate,
+        )
+        excludes = sorted(
+            self._terms(exclude, (), query_args, index),
+            key=estimate,
+            reverse=True,
+        )
+        scan = includes.pop(0) if includes else None
+        return scan, includes, excludes, query_args
+
+    def _match(self, include, exclude, filters):
+        '''
+        Return a select of the ids of files matching the query and its
+        arguments.  The select is None when nothing was specified, meaning
+        every tagged file.
+        '''
+        scan, probes, excludes, query_args = self._plan(
+            include, exclude, filters
+        )
+        if scan is None and not excludes:
+            return None, query_args
+        select = 'SELECT candidates.file FROM ({}) AS candidates'.format(
+            'SELECT DISTINCT file FROM file_tags' if scan is None
+            else scan.scan
+        )
+        conditions = (
+            [term.probe for term in probes] +
+            ['NOT ' + term.probe for term in excludes]
+        )
+        if conditions:
+            select += ' WHERE ' + ' AND '.join(conditions)
+        return select, query_args
+
+    def explain(self, include, exclude, filters=()):
+        '''
+        Describe the plan for a query as (step, term, estimated files,
+        actual files) tuples, followed by SQLite's own plan.
+        '''
+        scan, probes, excludes, query_args = self._plan(
+            include, exclude, filters
+        )
+
+        def count(select):
+            return self.cursor.execute(
+                'SELECT count(1) FROM ({})'.format(select), query_args,
+            ).fetchone()[0]
+
+        out = []
+        if scan is None:
+            out.append((
+                'scan',
+                '(all tagged files)',
+                None,
+                count('SELECT DISTINCT file FROM file_tags'),
+            ))
+        else:
+            out.append(('scan', scan.text, scan.estimate, count(scan.scan)))
+        for step, terms in (('probe', probes), ('exclude', excludes)):
+            for term in terms:
+                out.append((step, term.text, term.estimate, count(term.scan)))
+        match, query_args = self._match(include, exclude, filters)
+        if match is None:
+            match = 'SELECT DISTINCT file FROM file_tags'
+        out.append((
+            'result',
+            '',
+            None if scan is None else scan.estimate,
+            count(match),
+        ))
+        for row in self.cursor.execute(
+                'EXPLAIN QUERY PLAN ' + match, query_args).fetchall():
+            out.append(('sqlite', row[-1], None, None))
+        return out
+
+    def query(
+            self, include, exclude, add_path=False, batch_size=100,
+            filters=(), columns=None):
+        '''
+        Yield a Row for each matching file.  If columns is given, the rows'
+        tags only contain those keys and the tag blob isn't read at all.
+        '''
+        key = (
+            frozenset(include),
+            frozenset(exclude),
+            frozenset(filters),
+            add_path,
+            None if columns is None else tuple(columns),
+        )
+        generation = self._generation()
+        cached = self.results.get(key)
+        if cached is not None and cached[0] == generation:
+            self.hits += 1
+            self.results.move_to_end(key)
+            for row in cached[1]:
+                yield row.copy()
+            return
+        self.misses += 1
+        rows = []
+
+        match, query_args = self._match(include, exclude, filters)
+        query_select = 'SELECT files.id, files.segment'
+        if columns is None:
+            query_select += ', files.tags'
+        else:
+            for index, column in enumerate(columns):
+                query_select += (
+                    ', (SELECT json_group_array(tag_names.value) '
+                    'FROM file_tags JOIN tag_names ON tag_names.id = file_tags.tag '
+                    'WHERE file_tags.file = files.id AND '
+                    'tag_names.key = :column{})'.format(index)
                 )
-            query_args['tag{}'.format(query_index[0])] = item
-            query_index[0] += 1
-
-        for item in include:
-            build_select(query_include, item)
-
-        if len(query_include) == 0:
-            query_include.append('SELECT file FROM tags')
-
-        for item in exclude:
-            build_select(query_exclude, item)
-
-        if query_index[0] == 0:
-            query_select = 'SELECT id FROM files WHERE tags is not NULL LIMIT :size OFFSET :offset'
+                query_args['column{}'.format(index)] = column
+        if add_path:
+            query_select += (
+                ', paths.path FROM files JOIN paths ON paths.file = files.id'
+            )
         else:
-            if query_include:
-                query_exclude.insert(0, ' INTERSECT '.join(query_include))
-            query_select = (
-                ' EXCEPT '.join(query_exclude) + ' LIMIT :size OFFSET :offset'
+            query_select += ' FROM files'
+        if match is None:
+            query_select += ' WHERE files.tags is not NULL'
+        else:
+            query_select += ' WHERE files.id IN ({})'.format(match)
+
+        # Execute the query once and stream the results in batches on a
+        # dedicated cursor.
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query_select, query_args)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                for row in batch:
+                    path = row[-1] if add_path else None
+                    if columns is None:
+                        out = Row(row[0], row[1], raw=row[2], path=path)
+                    else:
+                        tags = {}
+                        for column, values in zip(columns, row[2:]):
+                            values = json.loads(values)
+                            if values:
+                                tags[column] = set(values)
+                        out = Row(row[0], row[1], tags=tags, path=path)
+                    if rows is not None:
+                        rows.append(out)
+                        if len(rows) > self.result_cache_rows:
+                            rows = None
+                    yield out.copy()
+                if len(batch) < batch_size:
+                    break
+        finally:
+            cursor.close()
+        # Only reached if every row was read
+        if rows is not None:
+            self.results[key] = (generation, rows)
+            self.results.move_to_end(key)
+            while len(self.results) > self.result_cache_size:
+                self.results.popitem(last=False)
+
+    def query_tags(self, method, arg, batch_size=100, counts=False):
+        '''
+        Yield tags matching arg, or (tag, file count) pairs if counts is
+        set.
+        '''
+        if method == 'prefix':
+            arg = arg + '%'
+        elif method == 'anywhere':
+            arg = '%' + arg + '%'
+        if method == 'anywhere' and self.tag_search:
+            # Trigram lookup instead of a full scan (needs 3+ characters to
+            # narrow anything, but is still correct with fewer)
+            match = (
+                'id IN (SELECT rowid FROM tag_names_fts WHERE tag LIKE :arg)'
             )
-        
-        # Perform the query in batches, and manually apply the rest of the
-        # filtering.
-        batch_size = 100
-        batch_index = 0
-        while True:
-            query_args['offset'] = batch_index * batch_size
-            query_args['size'] = batch_size
-            batch = set(
-                self.cursor.execute(query_select, query_args).fetchall()
+        else:
+            match = 'tag LIKE :arg'
+        # Order in the NOCASE index's collation so prefix matches come
+        # straight off the index rather than being sorted, and execute the
+        # query once, streaming it in batches on a dedicated cursor, so the
+        # match and any sort aren't redone for every batch.  Names are only
+        # pruned by sweeps, so skip any that are unused.
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(
+                'SELECT tag, count FROM tag_names WHERE ' + match + ' AND '
+                'count > 0 ORDER BY tag COLLATE NOCASE',
+                {
+                    'arg': arg,
+                },
             )
-            batch_index += 1
-            for (fid,) in batch:
-                segment, tags = self.cursor.execute(
-                    'SELECT segment, tags FROM files WHERE id = :fid LIMIT 1',
-                    {
-                        'fid': fid,
-                    },
-                ).fetchone()
-                tags = polytaxis.decode_tags(tags.encode('utf-8'))
-                out = {
-                    'fid': fid,
-                    'segment': segment,
-                    'tags': tags,
-                }
-                if add_path:
-                    out['tags']['path'] = {self.query_path(fid)}
-                yield out
-            if len(batch) < batch_size:
-                break
-
-    def query_tags(self, method, arg):
-        batch_size = 100
-        batch_index = 0
-        while True:
-            if method == 'prefix':
-                batch = self.cursor.execute(
-                    'SELECT DISTINCT tag FROM tags WHERE tag LIKE :arg ORDER BY tag ASC LIMIT :size OFFSET :offset',
-                    {
-                        'arg': arg + '%',
-                        'offset': batch_index * batch_size,
-                        'size': batch_size,
-                    },
-                ).fetchall()
-            elif method == 'anywhere':
-                batch = self.cursor.execute(
-                    'SELECT DISTINCT tag FROM tags WHERE tag LIKE :arg ORDER BY tag ASC LIMIT :size OFFSET :offset',
-                    {
-                        'arg': '%' + arg + '%',
-                        'offset': batch_index * batch_size,
-                        'size': batch_size,
-                    },
-                ).fetchall()
-            batch_index += 1 
-            for (tag,) in batch:
-                yield tag
-            if len(batch) < batch_size:
-                break
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                for tag, count in batch:
+                    yield (tag, count) if counts else tag
+                if len(batch) < batch_size:
+                    break
+        finally:
+            cursor.close()
+
+    def facets(self, key, include=(), exclude=(), filters=()):
+        '''
+        Return (value, file count) pairs for the values of key among the
+        files matching the query, most common first.
+        '''
+        match, query_args = self._match(include, exclude, filters)
+        query_args['facet'] = key
+        if match is None:
+            # Every tagged file, so the maintained counts are the answer
+            return self.cursor.execute(
+                'SELECT value, count FROM tag_names '
+                'WHERE key = :facet AND count > 0 '
+                'ORDER BY count DESC, sort_key ASC',
+                query_args,
+            ).fetchall()
+        return self.cursor.execute(
+            'SELECT tag_names.value, count(1) AS matched FROM tag_names '
+            'JOIN file_tags ON file_tags.tag = tag_names.id '
+            'WHERE tag_names.key = :facet AND file_tags.file IN ({}) '
+            'GROUP BY tag_names.id '
+            'ORDER BY matched DESC, tag_names.sort_key ASC'.format(match),
+            query_args,
+        ).fetchall()
 
 
 def _get(row, column):
@@ -293,32 +807,59 @@ def filter(filters, rows):
         yield row
 
 
+def _sort_key(direction, column, salt):
+    if direction == 'rand':
+        return lambda row: hashlib.md5(
+            _get(row, column).encode('utf-8') + salt
+        ).digest()
+    return lambda row: _natkey(_get(row, column))
+
+
 def sort(sort_info, rows):
     salt = '{:03d}'.format(random.randint(0, 999)).encode('utf-8')
+    rows = list(rows)
     random.shuffle(rows)
-    def cmp(x, y):
-        for direction, column in sort_info:
-            x_val = _get(x, column)
-            y_val = _get(y, column)
-            if direction == 'rand':
-                x_val = hashlib.md5(x_val.encode('utf-8') + salt).digest()
-                y_val = hashlib.md5(y_val.encode('utf-8') + salt).digest()
-            else:
-                x_val = _natkey(x_val)
-                y_val = _natkey(y_val)
-            less = 0
-            if y_val is None:
-                less = 1
-            elif x_val < y_val:
-                less = -1
-            elif x_val > y_val:
-                less = 1
-            if less == 0:
-                continue
-            if direction == 'desc':
-                return less * -1
-            else:
-                return less
-        return 0
-    return sorted(rows, key=functools.cmp_to_key(cmp))
+    # Compute every row's keys once, then sort from the least to the most
+    # significant column, relying on sort stability to keep earlier orders
+    keys = [
+        _sort_key(direction, column, salt) for direction, column in sort_info
+    ]
+    decorated = [(tuple(key(row) for key in keys), row) for row in rows]
+    for index in reversed(range(len(sort_info))):
+        decorated.sort(
+            key=lambda item: item[0][index],
+            reverse=sort_info[index][0] == 'desc',
+        )
+    return [row for _, row in decorated]
+
+
+@functools.total_ordering
+class _Descending(object):
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
 
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def top(sort_info, rows, count):
+    '''
+    Return the first count rows in sort order, holding at most count rows in
+    memory.  Ties are broken randomly like in sort.
+    '''
+    salt = '{:03d}'.format(random.randint(0, 999)).encode('utf-8')
+    keys = [
+        _sort_key(direction, column, salt) for direction, column in sort_info
+    ]
+    descending = [direction == 'desc' for direction, column in sort_info]
+    def key(row):
+        return tuple(
+            _Descending(sort_key(row)) if reverse else sort_key(row)
+            for sort_key, reverse in zip(keys, descending)
+        ) + (random.random(),)
+    return heapq.nsmallest(count, rows, key=key)
@@ -1,8 +1,11 @@
 import os
+import stat
 import argparse
 import signal
 import time
-import datetime
+import collections
+import concurrent.futures
+import threading
 
 import watchdog
 import watchdog.events
@@ -11,6 +14,8 @@ import appdirs
 import polytaxis
 
 from polytaxis_monitor import common
+from polytaxis_monitor import options
+from polytaxis_monitor import server
 
 verbose = False
 super_verbose = False
@@ -21,14 +26,59 @@ def signal_handler(signal, frame):
     die = True
 signal.signal(signal.SIGINT, signal_handler)
 
-nextcommit = None
-commit_wait = datetime.timedelta(seconds=5)
-
 sleep_time = 5
 
+# Updates where the tags were reread but hadn't changed
+unchanged_updates = 0
+
 log = print
 
 
+class SegmentCache(object):
+    '''
+    Bounded, least-recently-used map of (parent id, segment) -> id, the
+    edges of the file tree, so resolving hot paths doesn't touch the
+    database.  Every write that removes or renames a row must update it.
+    '''
+    def __init__(self, size=100000):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, parent, segment):
+        key = (parent, segment)
+        fid = self.entries.get(key)
+        if fid is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return fid
+
+    def put(self, parent, segment, fid):
+        key = (parent, segment)
+        self.entries[key] = fid
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, parent, segment):
+        self.entries.pop((parent, segment), None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def discard_fids(self, fids):
+        '''Forget the given ids and their children.'''
+        for key, fid in list(self.entries.items()):
+            if fid in fids or key[0] in fids:
+                del self.entries[key]
+
+
+segments = SegmentCache()
+
+
 def get_fid_and_raw_tags(parent, segment):
     got = cursor.execute(
         'SELECT id, tags FROM files WHERE parent is :parent AND segment = :segment LIMIT 1', 
@@ -43,6 +93,9 @@ def get_fid_and_raw_tags(parent, segment):
 
 
 def get_fid(parent, segment):
+    fid = segments.get(parent, segment)
+    if fid is not None:
+        return fid
     got = cursor.execute(
         'SELECT id FROM files WHERE parent is :parent AND segment = :segment LIMIT 1', 
         {
@@ -52,13 +105,63 @@ def get_fid(parent, segment):
     ).fetchone()
     if got is None:
         return None
+    segments.put(parent, segment, got[0])
     return got[0]
 
 
-def create_tree(splits, tags=None):
+def get_path(fid):
+    return cursor.execute(
+        'SELECT path FROM paths WHERE file = :id',
+        {
+            'id': fid,
+        },
+    ).fetchone()[0]
+
+
+def get_path_fid(path):
+    got = cursor.execute(
+        'SELECT file FROM paths WHERE path = :path',
+        {
+            'path': path,
+        },
+    ).fetchone()
+    if got is None:
+        return None
+    return got[0]
+
+
+def get_stats(fid):
+    return tuple(cursor.execute(
+        'SELECT mtime, size, inode FROM files WHERE id = :id',
+        {
+            'id': fid,
+        },
+    ).fetchone())
+
+
+def file_stats(filename):
+    '''
+    Returns the (mtime, size, inode) stored for a file, or None if filename
+    isn't a regular file.
+    '''
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    return info.st_mtime_ns, info.st_size, info.st_ino
+
+
+no_stats = (None, None, None)
+
+
+def create_tree(splits, tags=None, stats=no_stats):
     fid = None
+    path = None
     last_index = len(splits) - 1
     for index, split in enumerate(splits):
+        path = common.join_path(path, split)
         next_fid = get_fid(fid, split)
         if next_fid is None:
             args = {
@@ -67,30 +170,44 @@ def create_tree(splits, tags=None):
             }
             if tags and index == last_index:
                 args['tags'] = polytaxis.encode_tags(tags).decode('utf-8')
+                args['mtime'], args['size'], args['inode'] = stats
             else:
                 args['tags'] = None
+                args['mtime'], args['size'], args['inode'] = no_stats
             cursor.execute(
-                'INSERT INTO files (id, parent, segment, tags) VALUES (NULL, :parent, :segment, :tags)',
+                'INSERT INTO files (id, parent, segment, tags, mtime, size, inode) VALUES (NULL, :parent, :segment, :tags, :mtime, :size, :inode)',
                 args,
             )
             next_fid = cursor.lastrowid
+            segments.put(fid, split, next_fid)
+            cursor.execute(
+                'INSERT INTO paths (file, path) VALUES (:id, :path)',
+                {
+                    'id': next_fid,
+                    'path': path,
+                },
+            )
         fid = next_fid
     return fid
 
 
-def create_file(filename, tags):
+def create_file(filename, tags, stats=no_stats):
     if super_verbose:
         log('DEBUG: Created: [{}]'.format(filename))
     splits = common.split_abs_path(filename)
-    return create_tree(splits, tags)
+    return create_tree(splits, tags, stats)
 
 
-def update_file(fid, tags):
+def update_file(fid, tags, stats=no_stats):
+    mtime, size, inode = stats
     cursor.execute(
-        'UPDATE files SET tags = :tags WHERE id = :fid',
+        'UPDATE files SET tags = :tags, mtime = :mtime, size = :size, inode = :inode WHERE id = :fid',
         {
             'fid': fid,
             'tags': polytaxis.encode_tags(tags).decode('utf-8'),
+            'mtime': mtime,
+            'size': size,
+            'inode': inode,
         },
     )
 
@@ -105,14 +222,16 @@ def clean_tree(fid):
         return
     while fid is not None:
         parent = cursor.execute(
-            'SELECT parent FROM files WHERE id is :id',
+            'SELECT parent, segment FROM files WHERE id is :id',
             {
                 'id': fid,
             }
         ).fetchone()
         if parent is not None:
-            (parent,) = parent
+            (parent, segment) = parent
+            segments.discard(parent, segment)
         cursor.execute('DELETE FROM files WHERE id is :id', {'id': fid})
+        cursor.execute('DELETE FROM paths WHERE file is :id', {'id': fid})
         if cursor.execute(
                 'SELECT count(1) FROM files WHERE parent is :id',
                 {
@@ -123,32 +242,125 @@ def clean_tree(fid):
         fid = parent
 
 
-def delete_file(fid):
+def delete_file(fid, clean=True):
     parent = cursor.execute(
-        'SELECT parent FROM files WHERE id is :id',
+        'SELECT parent, segment FROM files WHERE id is :id',
         {
             'id': fid,
         }
     ).fetchone()
     if parent is not None:
-        (parent,) = parent
+        (parent, segment) = parent
+        segments.discard(parent, segment)
     cursor.execute('DELETE FROM files WHERE id is :id', {'id': fid})
-    clean_tree(parent)
+    cursor.execute('DELETE FROM paths WHERE file is :id', {'id': fid})
+    if clean:
+        clean_tree(parent)
+    return parent
+
+
+def delete_fids(fids):
+    '''
+    Delete files, their paths and their tags, without cleaning up
+    ancestors.
+    '''
+    fids = set(fids)
+    segments.discard_fids(fids)
+    # Kept for the connection's lifetime and emptied first, so a delete that
+    # failed partway doesn't break every later one
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS doomed (id INTEGER PRIMARY KEY)')
+    cursor.execute('DELETE FROM doomed')
+    cursor.executemany(
+        'INSERT INTO doomed (id) VALUES (?)',
+        ((fid,) for fid in fids),
+    )
+    cursor.execute('DELETE FROM file_tags WHERE file IN (SELECT id FROM doomed)')
+    cursor.execute('DELETE FROM paths WHERE file IN (SELECT id FROM doomed)')
+    cursor.execute('DELETE FROM files WHERE id IN (SELECT id FROM doomed)')
+
+
+def delete_tree(fid):
+    '''Delete a file or directory and everything beneath it.'''
+    prefix, prefix_end = common.path_prefix_range(get_path(fid))
+    delete_fids([fid] + [
+        child for (child,) in cursor.execute(
+            'SELECT file FROM paths WHERE path >= :prefix AND path < :prefix_end',
+            {
+                'prefix': prefix,
+                'prefix_end': prefix_end,
+            },
+        ).fetchall()
+    ])
+
+
+def insert_tag_rows(rows):
+    '''Associate (tag, fid) pairs, interning any new tag names.'''
+    rows = list(rows)
+    cursor.executemany(
+        'INSERT OR IGNORE INTO tag_names (tag, key, value, sort_key) '
+        'VALUES (?, ?, ?, ?)',
+        (common.tag_columns(tag) for tag in set(tag for tag, fid in rows)),
+    )
+    cursor.executemany(
+        'INSERT OR IGNORE INTO file_tags (tag, file) '
+        'SELECT id, ?2 FROM tag_names WHERE tag = ?1',
+        rows,
+    )
+
+
+def delete_tag_rows(rows):
+    '''Disassociate (tag, fid) pairs.  Tag names are left for prune_tags.'''
+    cursor.executemany(
+        'DELETE FROM file_tags WHERE file = ?2 AND '
+        'tag = (SELECT id FROM tag_names WHERE tag = ?1)',
+        rows,
+    )
+
+
+def prune_tags():
+    '''Drop tag names no file uses any more.'''
+    cursor.execute(
+        'DELETE FROM tag_names WHERE NOT EXISTS '
+        '(SELECT 1 FROM file_tags WHERE file_tags.tag = tag_names.id)'
+    )
+    return cursor.rowcount
 
 
 def add_tags(fid, tags):
-    for key, values in tags.items():
-        for value in values:
-            cursor.execute('INSERT INTO tags (tag, file) VALUES (:tag, :fid)',
-                {
-                    'tag': polytaxis.encode_tag(key, value).decode('utf-8'),
-                    'fid': fid,
-                }
-            )
+    insert_tag_rows((tag, fid) for tag in encode_tag_set(tags))
 
 
 def remove_tags(fid):
-    cursor.execute('DELETE FROM tags WHERE file = :fid', {'fid': fid})
+    cursor.execute('DELETE FROM file_tags WHERE file = :fid', {'fid': fid})
+
+
+def encode_tag_set(tags):
+    return {
+        polytaxis.encode_tag(key, value).decode('utf-8')
+        for key, values in tags.items()
+        for value in values
+    }
+
+
+def update_tags(fid, old_tags, tags):
+    '''Only delete and insert the tag rows that differ.'''
+    old = encode_tag_set(old_tags)
+    new = encode_tag_set(tags)
+    delete_tag_rows((tag, fid) for tag in old - new)
+    insert_tag_rows((tag, fid) for tag in new - old)
+
+
+def update_stats(fid, stats):
+    mtime, size, inode = stats
+    cursor.execute(
+        'UPDATE files SET mtime = :mtime, size = :size, inode = :inode WHERE id = :fid',
+        {
+            'fid': fid,
+            'mtime': mtime,
+            'size': size,
+            'inode': inode,
+        },
+    )
 
 
 def locate(filename):
@@ -164,13 +376,19 @@ def locate(filename):
 
 
 def process(filename):
+    global unchanged_updates
     filename = os.path.abspath(filename)
     if verbose:
         log('\tScanning file [{}]'.format(filename))
     
     fid, old_raw_tags = locate(filename)
 
-    is_file = os.path.isfile(filename)
+    stats = file_stats(filename)
+    is_file = stats is not None
+    if is_file and fid is not None and stats == get_stats(fid):
+        if super_verbose:
+            log('DEBUG: Unchanged; skipping [{}]'.format(filename))
+        return
     tags = polytaxis.get_tags(filename) if is_file else None
 
     if tags is None and fid is None:
@@ -178,16 +396,23 @@ def process(filename):
             log('DEBUG: Not a file; skipping [{}]'.format(filename))
         pass
     elif tags is not None and fid is None:
-        fid = create_file(filename, tags)
+        fid = create_file(filename, tags, stats)
         add_tags(fid, tags)
     elif tags is not None and fid is not None:
-        if super_verbose:
-            log('DEBUG: Updating: [{}]'.format(filename))
-        update_file(fid, tags)
-        old_tags = polytaxis.decode_tags(old_raw_tags)
-        if tags != old_tags:
-            remove_tags(fid)
-            add_tags(fid, tags)
+        old_tags = (
+            {} if old_raw_tags is None
+            else polytaxis.decode_tags(old_raw_tags)
+        )
+        if tags == old_tags:
+            if super_verbose:
+                log('DEBUG: Tags unchanged: [{}]'.format(filename))
+            unchanged_updates += 1
+            update_stats(fid, stats)
+        else:
+            if super_verbose:
+                log('DEBUG: Updating: [{}]'.format(filename))
+            update_file(fid, tags, stats)
+            update_tags(fid, old_tags, tags)
     elif is_file and tags is None and fid is not None:
         if super_verbose:
             log('DEBUG: Deleted: [{}]'.format(filename))
@@ -198,20 +423,27 @@ def process(filename):
 def move_file(source, dest):
     source = os.path.abspath(source)
     dest = os.path.abspath(dest)
-    sparent = None
-    sfid = None
-    for split in common.split_abs_path(source):
-        sparent = sfid
-        sfid = get_fid(sparent, split)
-        if sfid is None:
+    sfid = get_path_fid(source)
+    if sfid is None:
+        if os.path.isdir(dest):
+            # Nothing beneath it is indexed yet
+            scan([dest])
+        else:
             process(dest)
-            return
-    dparent = None
-    dfid = None
+        return
+    sparent, ssegment = cursor.execute(
+        'SELECT parent, segment FROM files WHERE id = :id',
+        {
+            'id': sfid,
+        },
+    ).fetchone()
     dsplits = common.split_abs_path(dest)
     new_name = dsplits[-1]
     dsplits = dsplits[:-1]
     dfid = create_tree(dsplits)
+    replaced = get_fid(dfid, new_name)
+    if replaced is not None and replaced != sfid:
+        delete_tree(replaced)
     if super_verbose:
         log('DEBUG: Move {} -> {}'.format(source, dest))
     cursor.execute(
@@ -222,42 +454,602 @@ def move_file(source, dest):
             'id': sfid,
         },
     )
+    segments.discard(sparent, ssegment)
+    segments.put(dfid, new_name, sfid)
+    # Rewrite the paths of the file and everything beneath it at once
+    old_path = get_path(sfid)
+    old_prefix, old_prefix_end = common.path_prefix_range(old_path)
+    cursor.execute(
+        'UPDATE paths SET path = :path || substr(path, :length + 1) '
+        'WHERE file = :id OR (path >= :prefix AND path < :prefix_end)',
+        {
+            'path': common.join_path(get_path(dfid), new_name),
+            'length': len(old_path),
+            'id': sfid,
+            'prefix': old_prefix,
+            'prefix_end': old_prefix_end,
+        },
+    )
+    clean_tree(sparent)
 
-class MonitorHandler(watchdog.events.FileSystemEventHandler):
-    def _wait_or_commit(self):
-        global nextcommit
-        now = datetime.datetime.now()
-        if nextcommit is not None and now >= nextcommit:
-            conn.commit()
+
+class Ingest(object):
+    '''
+    Bulk writer for scans.  Directory ids are resolved through an in-memory
+    map and ids for new rows are allocated here, so new files and tags can
+    be inserted with executemany in batches, committing after each batch.
+    Nothing else may write to the database while an Ingest is in use.
+    '''
+    def __init__(self, batch_size=1000, report_interval=5):
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.segments = {}
+        self.next_fid = cursor.execute(
+            'SELECT coalesce(max(id), 0) + 1 FROM files'
+        ).fetchone()[0]
+        self.new_files = []
+        self.new_paths = []
+        self.updated_files = []
+        self.updated_stats = []
+        self.new_tags = []
+        self.removed_tags = []
+        self.cleanup = set()
+        self.count = 0
+        self.skipped = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def _allocate(self, parent, segment, path, tags, stats=no_stats):
+        fid = self.next_fid
+        self.next_fid += 1
+        self.new_files.append((fid, parent, segment, tags) + stats)
+        self.new_paths.append((fid, path))
+        return fid
+
+    def directory(self, dirname):
+        '''
+        Returns the directory's id (creating it if necessary) and a dict of
+        its indexed children, segment -> (id, raw tags, stats).
+        '''
+        fid = None
+        path = None
+        new = False
+        for split in common.split_abs_path(dirname):
+            parent = fid
+            path = common.join_path(path, split)
+            fid = self.segments.get((parent, split))
+            if fid is None:
+                if not new:
+                    fid = get_fid(parent, split)
+                if fid is None:
+                    fid = self._allocate(parent, split, path, None)
+                    new = True
+                self.segments[(parent, split)] = fid
+        children = {}
+        if not new:
+            for segment, child, raw_tags, *stats in cursor.execute(
+                    'SELECT segment, id, tags, mtime, size, inode FROM files WHERE parent = :parent',
+                    {
+                        'parent': fid,
+                    }):
+                children[segment] = (
+                    child,
+                    None if raw_tags is None else raw_tags.encode('utf-8'),
+                    tuple(stats),
+                )
+        return fid, children
+
+    def unchanged(self, children, filename, stats):
+        '''
+        Returns True (and counts the file as scanned) if the file's stats
+        match those stored when it was last indexed.
+        '''
+        child = children.get(os.path.basename(filename))
+        if child is None or child[2] != stats:
+            return False
+        self.count += 1
+        self.skipped += 1
+        return True
+
+    def apply(self, parent, children, filename, stats, tags):
+        global unchanged_updates
+        is_file = stats is not None
+        segment = os.path.basename(filename)
+        fid, old_raw_tags, old_stats = children.get(
+            segment, (None, None, None)
+        )
+        if tags is None and fid is None:
             if super_verbose:
-                log('DEBUG: Committed')
-            nextcommit = None
+                log('DEBUG: Not a file; skipping [{}]'.format(filename))
+        elif tags is not None and fid is None:
+            if super_verbose:
+                log('DEBUG: Created: [{}]'.format(filename))
+            fid = self._allocate(
+                parent,
+                segment,
+                filename,
+                polytaxis.encode_tags(tags).decode('utf-8'),
+                stats,
+            )
+            self._add_tags(fid, tags)
+        elif tags is not None and fid is not None:
+            old_tags = (
+                {} if old_raw_tags is None
+                else polytaxis.decode_tags(old_raw_tags)
+            )
+            if tags != old_tags:
+                if super_verbose:
+                    log('DEBUG: Updating: [{}]'.format(filename))
+                self.updated_files.append(
+                    (polytaxis.encode_tags(tags).decode('utf-8'),) +
+                    stats +
+                    (fid,)
+                )
+                old = encode_tag_set(old_tags)
+                new = encode_tag_set(tags)
+                self.removed_tags.extend((tag, fid) for tag in old - new)
+                self.new_tags.extend((tag, fid) for tag in new - old)
+            else:
+                unchanged_updates += 1
+                if old_stats != stats:
+                    self.updated_stats.append(stats + (fid,))
+        elif is_file and tags is None and fid is not None:
+            if super_verbose:
+                log('DEBUG: Deleted: [{}]'.format(filename))
+            # Ancestors are cleaned up at the end so that directory ids in
+            # the map stay valid
+            self.flush()
+            remove_tags(fid)
+            self.cleanup.add(delete_file(fid, clean=False))
+        self.count += 1
+        if (
+                len(self.new_files) +
+                len(self.updated_files) +
+                len(self.updated_stats)) >= self.batch_size:
+            self.flush()
+            conn.commit()
+            self.report()
+
+    def _add_tags(self, fid, tags):
+        self.new_tags.extend((tag, fid) for tag in encode_tag_set(tags))
+
+    def flush(self):
+        cursor.executemany(
+            'INSERT INTO files (id, parent, segment, tags, mtime, size, inode) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            self.new_files,
+        )
+        cursor.executemany(
+            'INSERT INTO paths (file, path) VALUES (?, ?)',
+            self.new_paths,
+        )
+        cursor.executemany(
+            'UPDATE files SET tags = ?, mtime = ?, size = ?, inode = ? WHERE id = ?',
+            self.updated_files,
+        )
+        cursor.executemany(
+            'UPDATE files SET mtime = ?, size = ?, inode = ? WHERE id = ?',
+            self.updated_stats,
+        )
+        delete_tag_rows(self.removed_tags)
+        insert_tag_rows(self.new_tags)
+        self.new_files = []
+        self.new_paths = []
+        self.updated_files = []
+        self.updated_stats = []
+        self.removed_tags = []
+        self.new_tags = []
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+        log('Scanned {} files, {} unchanged ({:.1f}s, {:.1f} files/sec)'.format(
+            self.count,
+            self.skipped,
+            now - self.start,
+            self.count / max(now - self.start, 1e-6),
+        ))
+
+    def finish(self):
+        self.flush()
+        for parent in self.cleanup:
+            clean_tree(parent)
+        self.cleanup = set()
+        conn.commit()
+        self.report(force=True)
+
+
+def sweep():
+    '''
+    Remove everything in the database that no longer exists on disk.  The
+    tree is loaded in one query, each indexed directory is listed once, and
+    missing subtrees are deleted with set-based statements.
+    '''
+    start = time.time()
+    parents = {}
+    children = collections.defaultdict(list)
+    for fid, parent, segment in cursor.execute(
+            'SELECT id, parent, segment FROM files'):
+        parents[fid] = parent
+        children[parent].append((fid, segment))
+    log('Loaded {} entries ({:.1f}s)'.format(
+        len(parents), time.time() - start
+    ))
+
+    start = time.time()
+    missing = []
+    listed = 0
+    stack = [(None, None)]
+    while stack:
+        fid, path = stack.pop()
+        if fid not in children:
+            continue
+        if path is None:
+            names = None
         else:
-            nextcommit = now + commit_wait
+            try:
+                names = set(os.listdir(path))
+            except (FileNotFoundError, NotADirectoryError):
+                names = set()
+            except OSError:
+                # Can't tell what's there, so leave it alone
+                continue
+            listed += 1
+        for child, segment in children[fid]:
+            child_path = common.join_path(path, segment)
+            if verbose:
+                log('Checking [{}]'.format(child_path))
+            if (
+                    os.path.exists(child_path) if names is None
+                    else segment in names):
+                stack.append((child, child_path))
+            else:
+                log('[{}] no longer exists, removing'.format(child_path))
+                missing.append(child)
+    log('Listed {} directories, {} missing ({:.1f}s)'.format(
+        listed, len(missing), time.time() - start
+    ))
+
+    start = time.time()
+    removed = set()
+    stack = list(missing)
+    while stack:
+        fid = stack.pop()
+        removed.add(fid)
+        stack.extend(child for child, _ in children.get(fid, ()))
+    # Remove directories left empty, like clean_tree
+    remaining = {}
+    for fid in missing:
+        parent = parents[fid]
+        while parent is not None:
+            remaining[parent] = remaining.get(
+                parent, len(children[parent])
+            ) - 1
+            if remaining[parent] > 0:
+                break
+            removed.add(parent)
+            parent = parents[parent]
+    delete_fids(removed)
+    pruned = prune_tags()
+    conn.commit()
+    log('Removed {} entries, {} unused tags ({:.1f}s)'.format(
+        len(removed), pruned, time.time() - start
+    ))
+
+
+def walk_files(path):
+    '''
+    Like os.walk, but yields (directory, regular file DirEntrys) so that
+    file types come from the directory listing.
+    '''
+    stack = [path]
+    while stack:
+        base = stack.pop()
+        files = []
+        try:
+            with os.scandir(base) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry)
+        except OSError:
+            continue
+        yield base, files
+
+
+def scan(directories, jobs=1, batch_size=1000, full=False):
+    '''
+    Index every file in directories.  Tags are read by a pool of jobs
+    threads while results are written here, in walk order, on the calling
+    thread.  Unless full is set, files whose stats haven't changed since
+    they were indexed aren't read.
+    '''
+    ingest = Ingest(batch_size=batch_size)
+    pending = collections.deque()
+
+    def apply_next():
+        parent, children, filename, stats, read = pending.popleft()
+        ingest.apply(parent, children, filename, stats, read.result())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for path in directories:
+            log('Scanning [{}]...'.format(path))
+            for base, entries in walk_files(os.path.abspath(path)):
+                if not entries:
+                    continue
+                parent, children = ingest.directory(base)
+                for entry in entries:
+                    try:
+                        info = entry.stat()
+                    except OSError:
+                        continue
+                    stats = info.st_mtime_ns, info.st_size, info.st_ino
+                    if not full and ingest.unchanged(
+                            children, entry.path, stats):
+                        continue
+                    if verbose:
+                        log('\tScanning file [{}]'.format(entry.path))
+                    pending.append((
+                        parent,
+                        children,
+                        entry.path,
+                        stats,
+                        pool.submit(polytaxis.get_tags, entry.path),
+                    ))
+                    # Bound the reads in flight
+                    if len(pending) >= jobs * 16:
+                        apply_next()
+        while pending:
+            apply_next()
+    ingest.finish()
+
+
+class CommitScheduler(object):
+    '''
+    Group commits on a timer thread.  Writes are committed latency seconds
+    after the first uncommitted write, or as soon as max_pending writes are
+    waiting, whichever comes first.  Writers must hold condition while
+    writing and report their writes with dirty().
+    '''
+    def __init__(self, latency=5, max_pending=1000):
+        self.latency = latency
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.pending = 0
+        self.first_dirty = None
+        self.commits = 0
+        self.committed = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.max_batch = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        '''Commit anything pending, then stop.'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+
+    def dirty(self, count=1):
+        if self.first_dirty is None:
+            self.first_dirty = time.monotonic()
+        self.pending += count
+        self.condition.notify()
+
+    def _commit(self):
+        conn.commit()
+        latency = time.monotonic() - self.first_dirty
+        self.commits += 1
+        self.committed += self.pending
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.max_batch = max(self.max_batch, self.pending)
+        if super_verbose:
+            log('DEBUG: Committed {} writes after {:.3f}s'.format(
+                self.pending, latency,
+            ))
+        self.pending = 0
+        self.first_dirty = None
+
+    def stats(self):
+        return {
+            'commits': self.commits,
+            'committed': self.committed,
+            'mean_latency': self.total_latency / max(self.commits, 1),
+            'max_latency': self.max_latency,
+            'mean_batch': self.committed / max(self.commits, 1),
+            'max_batch': self.max_batch,
+        }
+
+    def _run(self):
+        with self.condition:
+            while True:
+                if self.pending:
+                    timeout = (
+                        self.first_dirty + self.latency - time.monotonic()
+                    )
+                    if (
+                            timeout <= 0 or
+                            self.pending >= self.max_pending or
+                            self.stopping):
+                        self._commit()
+                        continue
+                elif self.stopping:
+                    break
+                else:
+                    timeout = None
+                self.condition.wait(timeout)
+
+
+class EventQueue(object):
+    '''
+    Coalesces filesystem events and applies them in batches on a worker
+    thread.  Events for the same path are merged, and a path's event is
+    only applied once the path has been quiet for quiet_period seconds.
+    '''
+    # Seconds to watch for descendant events after a directory move
+    moved_window = 10
+
+    def __init__(self, scheduler, quiet_period=1, batch_size=100):
+        self.scheduler = scheduler
+        self.quiet_period = quiet_period
+        self.batch_size = batch_size
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.received = 0
+        self.suppressed = 0
+        self.applied = 0
+        self.moved_directories = collections.deque()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        '''Apply everything pending without waiting, then stop.'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _put(self, key, action):
+        self.received += 1
+        self._queue(key, action)
+
+    def _queue(self, key, action):
+        # Reinserting keeps pending ordered by deadline
+        self.pending.pop(key, None)
+        self.pending[key] = (time.monotonic() + self.quiet_period, action)
+        self.condition.notify()
+
+    def process(self, filename):
+        with self.condition:
+            self._put(('process', filename), (process, filename))
+
+    def _follow(self, source, dest):
+        '''
+        Remove pending process events for source and anything beneath it, and
+        return their paths as they are after the move.
+        '''
+        prefix = os.path.join(source, '')
+        followed = []
+        for key in list(self.pending):
+            if key[0] != 'process':
+                continue
+            path = key[1]
+            if path == source or path.startswith(prefix):
+                del self.pending[key]
+                followed.append(dest + path[len(source):])
+        return followed
+
+    def move(self, source, dest, is_directory=False):
+        with self.condition:
+            # Events still waiting out the quiet period would otherwise be
+            # applied to paths that no longer exist
+            followed = self._follow(source, dest)
+            # Moving a directory moves everything beneath it, so drop the
+            # events for its descendants that follow
+            now = time.monotonic()
+            while (
+                    self.moved_directories and
+                    self.moved_directories[0][0] < now - self.moved_window):
+                self.moved_directories.popleft()
+            for _, moved_source, moved_dest in self.moved_directories:
+                if (
+                        source.startswith(os.path.join(moved_source, '')) and
+                        dest == moved_dest + source[len(moved_source):]):
+                    self.received += 1
+                    self.suppressed += 1
+                    for path in followed:
+                        self._queue(('process', path), (process, path))
+                    return
+            if is_directory:
+                self.moved_directories.append((now, source, dest))
+            # move_file takes care of whatever is at dest
+            self.pending.pop(('process', dest), None)
+            self._put(('move', source, dest), (move_file, source, dest))
+            # Apply the followed events after the move so they update the
+            # moved files rather than creating new ones
+            for path in followed:
+                self._queue(('process', path), (process, path))
+
+    def _next_batch(self):
+        with self.condition:
+            while True:
+                if self.pending:
+                    deadline, _ = next(iter(self.pending.values()))
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or self.stopping:
+                        break
+                elif self.stopping:
+                    return None
+                else:
+                    timeout = None
+                self.condition.wait(timeout)
+            now = time.monotonic()
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                key, (deadline, action) = next(iter(self.pending.items()))
+                if deadline > now and not self.stopping:
+                    break
+                del self.pending[key]
+                batch.append(action)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            with self.scheduler.condition:
+                for function, *args in batch:
+                    try:
+                        function(*args)
+                    except Exception as error:
+                        log('Failed to apply {}{}: {}'.format(
+                            function.__name__, tuple(args), error
+                        ))
+                self.scheduler.dirty(len(batch))
+            self.applied += len(batch)
+            if super_verbose:
+                log('DEBUG: Applied {} events ({} received, {} applied)'.format(
+                    len(batch), self.received, self.applied,
+                ))
+
+
+class MonitorHandler(watchdog.events.FileSystemEventHandler):
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
 
     def on_created(self, event):
         if super_verbose:
             log('Event: create {}'.format(event.src_path))
-        process(event.src_path)
-        self._wait_or_commit()
+        self.queue.process(event.src_path)
 
     def on_deleted(self, event):
         if super_verbose:
             log('Event: delete {}'.format(event.src_path))
-        process(event.src_path)
-        self._wait_or_commit()
+        self.queue.process(event.src_path)
 
     def on_modified(self, event):
         if super_verbose:
             log('Event: modify {}'.format(event.src_path))
-        process(event.src_path)
-        self._wait_or_commit()
+        self.queue.process(event.src_path)
 
     def on_moved(self, event):
         if super_verbose:
             log('Event: move {} -> {}'.format(event.src_path, event.dest_path))
-        move_file(event.src_path, event.dest_path)
-        self._wait_or_commit()
+        self.queue.move(event.src_path, event.dest_path, event.is_directory)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -274,6 +1066,58 @@ def main():
         action='store_true',
         help='Walk directories for missed file changes before monitoring.',
     )
+    parser.add_argument(
+        '--full_scan',
+        action='store_true',
+        help='Reread tags of every file while scanning, not just files whose modification time, size or inode changed.',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of threads reading tags while scanning.',
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=1000,
+        help='Number of files to write per transaction while scanning.',
+    )
+    parser.add_argument(
+        '--quiet_period',
+        type=float,
+        default=1,
+        help='Seconds a path must go without events before changes to it are indexed.',
+    )
+    parser.add_argument(
+        '--commit_latency',
+        type=float,
+        default=5,
+        help='Maximum seconds between indexing a change and committing it.',
+    )
+    parser.add_argument(
+        '--commit_size',
+        type=int,
+        default=1000,
+        help='Commit as soon as this many changes are waiting.',
+    )
+    parser.add_argument(
+        '--segment_cache',
+        type=int,
+        default=100000,
+        help='Number of path segment to id mappings to keep in memory.',
+    )
+    options.add_db_arguments(parser)
+    parser.add_argument(
+        '--serve',
+        help='Also serve queries for ptq --server on a Unix socket.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--socket',
+        help='Query server socket path. Defaults to one in the data directory.',
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -298,70 +1142,69 @@ def main():
     
     global cursor
     global conn
-    conn, cursor = common.open_db()
+    conn, cursor = common.open_db(**options.db_options(args))
+    segments.size = args.segment_cache
 
     if args.scan:
         log('Looking for deleted files...')
-        stack = [(False, None, None)]
-        parts = []
-        last_parent = None
-        while stack:
-            scanned, fid, segment = stack.pop()
-            if not scanned:
-                stack.append((True, fid, segment))
-                if segment:
-                    parts.append(segment)
-                for next_segment, next_id in cursor.execute(
-                        'SELECT segment, id FROM files WHERE parent is :parent',
-                        {
-                            'parent': fid,
-                        }):
-                    stack.append((False, next_id, next_segment))
-            else:
-                if parts:
-                    joined = os.path.join(*parts)
-                    if verbose:
-                        log('Checking [{}]'.format(joined))
-                    if joined and not os.path.exists(joined):
-                        log('[{}] no longer exists, removing'.format(joined))
-                        remove_tags(fid)
-                        delete_file(fid)
-                    parts.pop()
-
-        for path in args.directory:
-            log('Scanning [{}]...'.format(path))
-            for base, dirnames, filenames in os.walk(path):
-                for filename in filenames:
-                    abs_filename = os.path.join(base, filename)
-                    process(abs_filename)
+        sweep()
 
-    conn.commit()
+        scan(
+            args.directory,
+            jobs=args.jobs,
+            batch_size=args.batch_size,
+            full=args.full_scan,
+        )
 
-    if os.path.exists('/dev/shm'):
-        tmpdir = '/dev/shm/polytaxis-monitor-{}/'.format(os.getpid())
-    else:
-        tmpdir = '/tmp/polytaxis-monitor-{}/'.format(os.getpid())
-    os.makedirs(tmpdir, exist_ok=True)
+    conn.commit()
 
+    scheduler = CommitScheduler(
+        latency=args.commit_latency,
+        max_pending=args.commit_size,
+    )
+    scheduler.start()
+    queue = EventQueue(scheduler, quiet_period=args.quiet_period)
+    queue.start()
+    query_server = None
+    if args.serve:
+        query_server = server.QueryServer(
+            args.socket, **options.db_options(args)
+        )
+        log('Serving queries at [{}]'.format(query_server.path))
+        query_server.start()
     observer = watchdog.observers.Observer()
-    handler = MonitorHandler()
+    handler = MonitorHandler(queue)
     for path in args.directory:
         log('Starting watch on [{}]'.format(path))
         observer.schedule(handler, path, recursive=True)
-    observer.schedule(handler, tmpdir, recursive=False)
     observer.start()
     try:
         while not die:
             time.sleep(sleep_time)
-            if nextcommit and datetime.datetime.now() > nextcommit:
-                with open(os.path.join(tmpdir, 'jostle'), 'w') as file:
-                    file.write(repr(nextcommit))
     except KeyboardInterrupt:
         log('Received keyboard interrupt, please wait {} seconds'.format(
             sleep_time,
         ))
     observer.stop()
     observer.join()
+    if query_server is not None:
+        query_server.stop()
+    queue.stop()
+    scheduler.stop()
+    log('Received {} events, suppressed {}, applied {}'.format(
+        queue.received, queue.suppressed, queue.applied,
+    ))
+    log(
+        'Committed {committed} writes in {commits} commits '
+        '(mean latency {mean_latency:.3f}s, max {max_latency:.3f}s; '
+        'mean batch {mean_batch:.1f}, max {max_batch})'.format(
+            **scheduler.stats()
+        )
+    )
+    log('Segment cache: {} hits, {} misses'.format(
+        segments.hits, segments.misses,
+    ))
+    log('Skipped {} updates with unchanged tags'.format(unchanged_updates))
 
 if __name__ == '__main__':
     main()
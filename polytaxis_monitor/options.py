@@ -0,0 +1,42 @@
+# Kept apart from common so that parsers can be built without importing the
+# query and indexing code
+
+
+journal_modes = ['wal', 'delete', 'truncate', 'persist', 'memory']
+synchronous_modes = ['off', 'normal', 'full', 'extra']
+
+
+def add_db_arguments(parser):
+    parser.add_argument(
+        '--journal_mode',
+        choices=journal_modes,
+        default='wal',
+        help='SQLite journal mode.  With wal, queries don\'t block on the monitor\'s writes.',
+    )
+    parser.add_argument(
+        '--synchronous',
+        choices=synchronous_modes,
+        default='normal',
+        help='SQLite synchronous setting.',
+    )
+    parser.add_argument(
+        '--cache_size',
+        type=int,
+        default=-65536,
+        help='SQLite page cache size, in pages, or KiB if negative.',
+    )
+    parser.add_argument(
+        '--mmap_size',
+        type=int,
+        default=256 * 1024 * 1024,
+        help='Bytes of the database to memory map.',
+    )
+
+
+def db_options(args):
+    return {
+        'journal_mode': args.journal_mode,
+        'synchronous': args.synchronous,
+        'cache_size': args.cache_size,
+        'mmap_size': args.mmap_size,
+    }
@@ -0,0 +1,62 @@
+import collections.abc
+
+
+class Row(collections.abc.Mapping):
+    '''
+    A QueryDB.query result, mapping 'fid', 'segment' and 'tags' (with the
+    path under 'path' if requested).  Tags are only decoded when first
+    accessed, so rows that are only used for their path or id stay cheap.
+    '''
+    __slots__ = ('fid', 'segment', 'path', '_raw', '_tags')
+
+    def __init__(self, fid, segment, raw=None, tags=None, path=None):
+        self.fid = fid
+        self.segment = segment
+        self.path = path
+        self._raw = raw
+        self._tags = tags
+        if tags is not None and path is not None:
+            tags['path'] = {path}
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            if self._raw is None:
+                self._tags = {}
+            else:
+                # Rows from a query server arrive decoded, so its clients
+                # never need polytaxis
+                import polytaxis
+                self._tags = polytaxis.decode_tags(self._raw.encode('utf-8'))
+            if self.path is not None:
+                self._tags['path'] = {self.path}
+        return self._tags
+
+    def copy(self):
+        if self._tags is None:
+            tags = None
+        else:
+            # Callers may modify the value sets of cached rows' copies
+            tags = {key: set(values) for key, values in self._tags.items()}
+        return Row(
+            self.fid,
+            self.segment,
+            raw=self._raw,
+            tags=tags,
+            path=self.path,
+        )
+
+    def __getitem__(self, key):
+        if key == 'fid':
+            return self.fid
+        if key == 'segment':
+            return self.segment
+        if key == 'tags':
+            return self.tags
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(('fid', 'segment', 'tags'))
+
+    def __len__(self):
+        return 3
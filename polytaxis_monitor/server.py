@@ -0,0 +1,174 @@
+import os
+import json
+import socket
+import socketserver
+import itertools
+import collections
+import contextlib
+import threading
+
+from polytaxis_monitor import common
+from polytaxis_monitor.client import ServerError, default_socket_path
+
+
+# Request methods.  Each takes a QueryDB and the request's parameters and
+# returns an iterable of results, and is used directly by ptq when not
+# talking to a server.
+
+def search(db, args, limit, add_path=False, project=False):
+    '''
+    If project is set, rows only carry the tags needed for the query's
+    col: and sort terms.
+    '''
+    includes, excludes, filters, sort, columns = common.parse_query(args)
+    if project:
+        columns = columns + [
+            column for direction, column in sort if column not in columns
+        ]
+    else:
+        columns = None
+    rows = db.query(
+        includes,
+        excludes,
+        add_path=add_path,
+        filters=filters,
+        columns=columns,
+    )
+    if sort:
+        # Keep only the best rows as they stream past rather than sorting
+        # everything, or sorting whichever rows came first
+        return common.top(sort, rows, limit)
+    return itertools.islice(rows, limit)
+
+
+def facets(db, key, args, limit):
+    includes, excludes, filters, sort, columns = common.parse_query(args)
+    return itertools.islice(db.facets(key, includes, excludes, filters), limit)
+
+
+def explain(db, args):
+    includes, excludes, filters, sort, columns = common.parse_query(args)
+    return db.explain(includes, excludes, filters)
+
+
+def columns(db, args):
+    return common.parse_query(args)[4]
+
+
+def query_tags(db, method, arg, limit, counts=False):
+    return itertools.islice(db.query_tags(method, arg, counts=counts), limit)
+
+
+def query_paths(db, fids):
+    return db.query_paths(fids).items()
+
+
+methods = {
+    'search': search,
+    'facets': facets,
+    'explain': explain,
+    'columns': columns,
+    'query_tags': query_tags,
+    'query_paths': query_paths,
+}
+
+
+def _encode(result):
+    if isinstance(result, common.Row):
+        result = {
+            'fid': result.fid,
+            'segment': result.segment,
+            'path': result.path,
+            'tags': {
+                key: list(values)
+                for key, values in result.tags.items()
+                if key != 'path'
+            },
+        }
+    return json.dumps({'result': result}).encode('utf-8') + b'\n'
+
+
+class Handler(socketserver.StreamRequestHandler):
+    # Buffer responses and flush once per request
+    wbufsize = -1
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                self.respond(line)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; drop the connection
+            pass
+
+    def finish(self):
+        try:
+            super(Handler, self).finish()
+        except (BrokenPipeError, ConnectionResetError):
+            # Closing tried to send what the client didn't stay for
+            self.rfile.close()
+
+    def respond(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            method = methods[request.pop('request')]
+            with self.server.db() as db:
+                for result in method(db, **request):
+                    self.wfile.write(_encode(result))
+            self.wfile.write(b'{"done": true}\n')
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception as e:
+            self.wfile.write(
+                json.dumps({'error': repr(e)}).encode('utf-8') + b'\n'
+            )
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Serve queries on a Unix socket from a pool of open QueryDBs, so clients
+    skip startup, connection setup and cold statement caches.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path=None, **db_options):
+        if path is None:
+            path = default_socket_path()
+        self.path = path
+        self.db_options = db_options
+        self.idle = collections.deque()
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                # Left behind by a server that didn't shut down cleanly
+                os.unlink(path)
+            else:
+                raise ServerError(
+                    'A server is already listening at [{}]'.format(path)
+                )
+            finally:
+                probe.close()
+        super(QueryServer, self).__init__(path, Handler)
+
+    @contextlib.contextmanager
+    def db(self):
+        try:
+            db = self.idle.pop()
+        except IndexError:
+            db = common.QueryDB(**self.db_options)
+        try:
+            yield db
+        finally:
+            self.idle.append(db)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.path)
@@ -1,22 +1,38 @@
 import unittest
 import sqlite3
 import operator
+import os
+import subprocess
+import sys
+import tempfile
+import time
 
 from mock import patch
 
 import polytaxis_monitor.common
 import polytaxis_monitor.main
+import polytaxis_monitor.client
+import polytaxis_monitor.server
 
-db = sqlite3.connect(':memory:')
+db = sqlite3.connect(':memory:', check_same_thread=False)
 db_cursor = db.cursor()
 polytaxis_monitor.common.init_db(db)
 polytaxis_monitor.main.conn = db
 polytaxis_monitor.main.cursor = db_cursor
 
+def tag_rows():
+    return db.execute(
+        'SELECT tag_names.tag, file_tags.file FROM file_tags '
+        'JOIN tag_names ON tag_names.id = file_tags.tag'
+    ).fetchall()
+
 class TestWrite(unittest.TestCase):
     def setUp(self):
-        db.execute('DELETE FROM tags')
+        db.execute('DELETE FROM file_tags')
+        db.execute('DELETE FROM tag_names')
         db.execute('DELETE FROM files')
+        db.execute('DELETE FROM paths')
+        polytaxis_monitor.main.segments.clear()
 
     def test_split_abs_path(self):
         self.assertEqual(
@@ -38,7 +54,7 @@ class TestWrite(unittest.TestCase):
         )
         polytaxis_monitor.main.add_tags(fid, tags)
         self.assertEqual(
-            db.execute('SELECT * FROM files').fetchall(),
+            db.execute('SELECT id, parent, segment, tags FROM files').fetchall(),
             [
                 (1, None, '/', None),
                 (2, 1, 'what', None),
@@ -48,7 +64,7 @@ class TestWrite(unittest.TestCase):
             ],
         )
         self.assertEqual(
-            db.execute('SELECT * FROM tags').fetchall(),
+            tag_rows(),
             [
                 ('a=b', 5),
             ],
@@ -56,20 +72,337 @@ class TestWrite(unittest.TestCase):
 
         polytaxis_monitor.main.remove_tags(fid)
         self.assertEqual(
-            db.execute('SELECT * FROM tags').fetchall(),
+            tag_rows(),
             [],
         )
+        self.assertEqual(polytaxis_monitor.main.prune_tags(), 1)
 
         polytaxis_monitor.main.delete_file(fid)
         self.assertEqual(
-            db.execute('SELECT * FROM files').fetchall(),
+            db.execute('SELECT id, parent, segment, tags FROM files').fetchall(),
             [],
         )
 
+    def test_ingest(self):
+        polytaxis_monitor.main.create_file('/a/old.txt', {'x': set([None])})
+        ingest = polytaxis_monitor.main.Ingest(batch_size=1)
+        parent, children = ingest.directory('/a')
+        ingest.apply(parent, children, '/a/old.txt', (1, 2, 3), {'y': set(['1'])})
+        parent, children = ingest.directory('/a/b')
+        ingest.apply(parent, children, '/a/b/new.txt', (4, 5, 6), {'z': set([None])})
+        ingest.finish()
+        self.assertEqual(
+            db.execute('SELECT id, parent, segment, tags FROM files').fetchall(),
+            [
+                (1, None, '/', None),
+                (2, 1, 'a', None),
+                (3, 2, 'old.txt', 'y=1\n'),
+                (4, 2, 'b', None),
+                (5, 4, 'new.txt', 'z\n'),
+            ],
+        )
+        self.assertEqual(
+            db.execute('SELECT * FROM paths WHERE file > 2').fetchall(),
+            [(3, '/a/old.txt'), (4, '/a/b'), (5, '/a/b/new.txt')],
+        )
+        self.assertCountEqual(
+            tag_rows(),
+            [('y=1', 3), ('z', 5)],
+        )
+
+        ingest = polytaxis_monitor.main.Ingest()
+        parent, children = ingest.directory('/a/b')
+        self.assertTrue(ingest.unchanged(children, '/a/b/new.txt', (4, 5, 6)))
+        self.assertFalse(ingest.unchanged(children, '/a/b/new.txt', (7, 5, 6)))
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'sub'))
+            names = [
+                os.path.join(root, 'sub', 'file{}'.format(index))
+                for index in range(20)
+            ]
+            for name in names:
+                open(name, 'w').close()
+            with patch(
+                    'polytaxis.get_tags',
+                    new=lambda filename: {'name': {os.path.basename(filename)}},
+                    ):
+                polytaxis_monitor.main.scan([root], jobs=4, batch_size=3)
+            paths = dict(db.execute('SELECT path, file FROM paths'))
+            self.assertCountEqual(
+                tag_rows(),
+                [
+                    ('name={}'.format(os.path.basename(name)), paths[name])
+                    for name in names
+                ],
+            )
+
+    def test_process_diff(self):
+        with tempfile.TemporaryDirectory() as root:
+            name = os.path.join(root, 'file')
+            open(name, 'w').close()
+            def process(tags):
+                with patch('polytaxis.get_tags', new=lambda filename: tags):
+                    # Force a reread even though the stats match
+                    with patch(
+                            'polytaxis_monitor.main.get_stats',
+                            new=lambda fid: None,
+                            ):
+                        polytaxis_monitor.main.process(name)
+            process({'a': {'1'}, 'b': {'2'}})
+            fid = polytaxis_monitor.main.get_path_fid(name)
+            inserted = []
+            insert_tag_rows = polytaxis_monitor.main.insert_tag_rows
+            def record(rows):
+                rows = list(rows)
+                inserted.extend(rows)
+                insert_tag_rows(rows)
+            with patch('polytaxis_monitor.main.insert_tag_rows', new=record):
+                process({'a': {'1'}, 'b': {'3'}})
+            self.assertEqual(inserted, [('b=3', fid)])
+            self.assertCountEqual(
+                tag_rows(),
+                [('a=1', fid), ('b=3', fid)],
+            )
+            unchanged = polytaxis_monitor.main.unchanged_updates
+            process({'a': {'1'}, 'b': {'3'}})
+            self.assertEqual(
+                polytaxis_monitor.main.unchanged_updates, unchanged + 1
+            )
+
+    def test_sweep(self):
+        tags = {'a': set(['b'])}
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'kept'))
+            open(os.path.join(root, 'kept', 'here.txt'), 'w').close()
+            for filename in [
+                    'kept/here.txt',
+                    'kept/gone.txt',
+                    'gone/deeper/gone.txt',
+                    ]:
+                fid = polytaxis_monitor.main.create_file(
+                    os.path.join(root, filename),
+                    tags,
+                )
+                polytaxis_monitor.main.add_tags(fid, tags)
+            polytaxis_monitor.main.sweep()
+            self.assertEqual(
+                [
+                    path[len(root):] for (path,) in db.execute(
+                        'SELECT path FROM paths WHERE path >= ? ORDER BY path',
+                        (root,),
+                    )
+                ],
+                ['', '/kept', '/kept/here.txt'],
+            )
+            self.assertEqual(
+                db.execute('SELECT count(1) FROM file_tags').fetchone()[0],
+                1,
+            )
+
+    def test_delete_after_failure(self):
+        tags = {'a': set(['b'])}
+        kept = polytaxis_monitor.main.create_file('/a/kept.txt', tags)
+        gone = polytaxis_monitor.main.create_file('/a/gone.txt', tags)
+        # As left by a delete that failed partway
+        db.execute('CREATE TEMP TABLE IF NOT EXISTS doomed (id INTEGER PRIMARY KEY)')
+        db.execute('INSERT INTO doomed (id) VALUES (?)', (kept,))
+        polytaxis_monitor.main.delete_fids([gone])
+        self.assertEqual(polytaxis_monitor.main.get_path_fid('/a/kept.txt'), kept)
+        self.assertIsNone(polytaxis_monitor.main.get_path_fid('/a/gone.txt'))
+
+    def test_move_replace(self):
+        tags = {'a': set(['b'])}
+        source = polytaxis_monitor.main.create_file('/x/new.txt', tags)
+        polytaxis_monitor.main.add_tags(source, tags)
+        dest = polytaxis_monitor.main.create_file('/y/old.txt', tags)
+        polytaxis_monitor.main.add_tags(dest, tags)
+        polytaxis_monitor.main.move_file('/x/new.txt', '/y/old.txt')
+        self.assertEqual(
+            db.execute('SELECT * FROM paths ORDER BY path').fetchall(),
+            [(1, '/'), (4, '/y'), (source, '/y/old.txt')],
+        )
+        self.assertEqual(
+            tag_rows(),
+            [('a=b', source)],
+        )
+
+    def test_segment_cache(self):
+        cache = polytaxis_monitor.main.SegmentCache(size=2)
+        cache.put(None, '/', 1)
+        cache.put(1, 'a', 2)
+        self.assertEqual(cache.get(None, '/'), 1)
+        cache.put(2, 'b', 3)
+        self.assertEqual(cache.get(1, 'a'), None)
+        self.assertEqual(cache.get(2, 'b'), 3)
+        cache.discard_fids({2})
+        self.assertEqual(cache.get(2, 'b'), None)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_segment_cache_consistent(self):
+        tags = {'a': set(['b'])}
+        fid = polytaxis_monitor.main.create_file('/x/y/z.txt', tags)
+        segments = polytaxis_monitor.main.segments
+        hits = segments.hits
+        self.assertEqual(polytaxis_monitor.main.locate('/x/y/z.txt')[0], fid)
+        self.assertEqual(segments.hits, hits + 3)
+        polytaxis_monitor.main.move_file('/x/y', '/w')
+        self.assertEqual(polytaxis_monitor.main.locate('/x/y/z.txt'), (None, None))
+        self.assertEqual(polytaxis_monitor.main.locate('/w/z.txt')[0], fid)
+        polytaxis_monitor.main.delete_file(fid)
+        self.assertEqual(segments.entries, {})
+
+    def test_move_directory(self):
+        tags = {'a': set(['b'])}
+        fids = [
+            polytaxis_monitor.main.create_file(filename, tags)
+            for filename in [
+                '/what/you/at/gamma.vob',
+                '/what/you/at/deeper/delta.vob',
+                '/what/you/atom.vob',
+            ]
+        ]
+        polytaxis_monitor.main.move_file('/what/you/at', '/what/is/that')
+        self.assertEqual(
+            [polytaxis_monitor.main.get_path(fid) for fid in fids],
+            [
+                '/what/is/that/gamma.vob',
+                '/what/is/that/deeper/delta.vob',
+                '/what/you/atom.vob',
+            ],
+        )
+
+class TestEventQueue(unittest.TestCase):
+    def test_coalesce(self):
+        applied = []
+        scheduler = polytaxis_monitor.main.CommitScheduler()
+        queue = polytaxis_monitor.main.EventQueue(scheduler, quiet_period=60)
+        with patch(
+                'polytaxis_monitor.main.process',
+                new=lambda filename: applied.append(filename),
+                ), patch(
+                'polytaxis_monitor.main.move_file',
+                new=lambda source, dest: applied.append((source, dest)),
+                ):
+            queue.process('/a')
+            queue.process('/b')
+            queue.process('/a')
+            queue.process('/c')
+            queue.move('/d', '/c')
+            queue.start()
+            queue.stop()
+        self.assertEqual(applied, ['/b', '/a', ('/d', '/c')])
+        self.assertEqual(queue.received, 5)
+        self.assertEqual(queue.applied, 3)
+        self.assertEqual(scheduler.pending, 3)
+
+    def test_directory_move(self):
+        applied = []
+        scheduler = polytaxis_monitor.main.CommitScheduler()
+        queue = polytaxis_monitor.main.EventQueue(scheduler, quiet_period=60)
+        with patch(
+                'polytaxis_monitor.main.move_file',
+                new=lambda source, dest: applied.append((source, dest)),
+                ):
+            queue.move('/a/b', '/c/d', True)
+            queue.move('/a/b/e', '/c/d/e')
+            queue.move('/a/b/e/f', '/c/d/e/f')
+            queue.move('/a/bb', '/c/dd')
+            queue.start()
+            queue.stop()
+        self.assertEqual(applied, [('/a/b', '/c/d'), ('/a/bb', '/c/dd')])
+        self.assertEqual(queue.suppressed, 2)
+
+    def test_process_follows_move(self):
+        applied = []
+        scheduler = polytaxis_monitor.main.CommitScheduler()
+        queue = polytaxis_monitor.main.EventQueue(scheduler, quiet_period=60)
+        with patch(
+                'polytaxis_monitor.main.process',
+                new=lambda filename: applied.append(filename),
+                ), patch(
+                'polytaxis_monitor.main.move_file',
+                new=lambda source, dest: applied.append((source, dest)),
+                ):
+            queue.process('/a/b')
+            queue.process('/a/bb')
+            queue.move('/a/b', '/a/c')
+            queue.start()
+            queue.stop()
+        self.assertEqual(applied, ['/a/bb', ('/a/b', '/a/c'), '/a/c'])
+        self.assertEqual(queue.received, 3)
+
+    def test_directory_move_pending(self):
+        db.execute('DELETE FROM file_tags')
+        db.execute('DELETE FROM tag_names')
+        db.execute('DELETE FROM files')
+        db.execute('DELETE FROM paths')
+        polytaxis_monitor.main.segments.clear()
+        scheduler = polytaxis_monitor.main.CommitScheduler()
+        queue = polytaxis_monitor.main.EventQueue(scheduler, quiet_period=60)
+        with tempfile.TemporaryDirectory() as root, patch(
+                'polytaxis.get_tags',
+                new=lambda filename: {'x': {os.path.basename(filename)}},
+                ):
+            def path(*parts):
+                return os.path.join(root, *parts)
+            os.makedirs(path('lib', 'a'))
+            for name in (path('lib', 'a', 'f1'), path('x')):
+                open(name, 'w').close()
+                polytaxis_monitor.main.process(name)
+            # A new file and a file moved in, both still pending when their
+            # directory moves
+            open(path('lib', 'a', 'f2'), 'w').close()
+            queue.process(path('lib', 'a', 'f2'))
+            os.rename(path('x'), path('lib', 'a', 'x'))
+            queue.move(path('x'), path('lib', 'a', 'x'))
+            os.rename(path('lib', 'a'), path('lib', 'b'))
+            queue.move(path('lib', 'a'), path('lib', 'b'), True)
+            for name in ('f1', 'f2', 'x'):
+                queue.move(path('lib', 'a', name), path('lib', 'b', name))
+            queue.start()
+            queue.stop()
+            self.assertCountEqual(
+                [
+                    (tag, polytaxis_monitor.main.get_path(fid))
+                    for tag, fid in tag_rows()
+                ],
+                [
+                    ('x=f1', path('lib', 'b', 'f1')),
+                    ('x=f2', path('lib', 'b', 'f2')),
+                    ('x=x', path('lib', 'b', 'x')),
+                ],
+            )
+
+class TestCommitScheduler(unittest.TestCase):
+    def test_commit_on_size(self):
+        scheduler = polytaxis_monitor.main.CommitScheduler(
+            latency=60,
+            max_pending=3,
+        )
+        scheduler.start()
+        with scheduler.condition:
+            scheduler.dirty(3)
+        deadline = time.monotonic() + 10
+        while scheduler.commits == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(scheduler.commits, 1)
+        with scheduler.condition:
+            scheduler.dirty(1)
+        scheduler.stop()
+        stats = scheduler.stats()
+        self.assertEqual(stats['commits'], 2)
+        self.assertEqual(stats['committed'], 4)
+        self.assertEqual(stats['max_batch'], 3)
+
 class TestQueryDB(unittest.TestCase):
     def setUp(self):
-        db.execute('DELETE FROM tags')
+        db.execute('DELETE FROM file_tags')
+        db.execute('DELETE FROM tag_names')
         db.execute('DELETE FROM files')
+        db.execute('DELETE FROM paths')
+        polytaxis_monitor.main.segments.clear()
         self.tag_sets = [
             {
                 'seven': set([None]),
@@ -138,6 +471,93 @@ class TestQueryDB(unittest.TestCase):
             ],
         )
 
+    def test_query_batched(self):
+        self.assertCountEqual(
+            [row['fid'] for row in self.query.query(['seven'], [], batch_size=1)],
+            self.fids,
+        )
+
+    def test_query_filters(self):
+        self.assertCountEqual(
+            [
+                row['fid'] for row in self.query.query(
+                    ['date=%'], [], filters={(operator.ge, 'date', '99')},
+                )
+            ],
+            [self.fids[0], self.fids[2]],
+        )
+        self.assertCountEqual(
+            [
+                row['fid'] for row in self.query.query(
+                    ['red'],
+                    [],
+                    filters={
+                        (operator.gt, 'date', '8'),
+                        (operator.lt, 'date', '99'),
+                    },
+                )
+            ],
+            [self.fids[1]],
+        )
+
+    def test_query_add_path(self):
+        self.assertCountEqual(
+            [
+                row['tags']['path']
+                for row in self.query.query(['seven'], [], add_path=True)
+            ],
+            [
+                {'/what/you/at/gamma.vob'},
+                {'/home/hebwy/loog.txt'},
+                {'/home/hebwy/noxx'},
+            ],
+        )
+
+    def test_query_lazy(self):
+        row = next(self.query.query(['juicy'], [], add_path=True))
+        self.assertEqual(row.path, '/what/you/at/gamma.vob')
+        self.assertIsNone(row._tags)
+        self.assertEqual(row['tags']['date'], {'99'})
+        self.assertEqual(row['tags']['path'], {'/what/you/at/gamma.vob'})
+
+    def test_query_columns(self):
+        self.assertCountEqual(
+            list(self.query.query(['seven'], [], columns=['date', 'red'])),
+            [
+                {'fid': self.fids[0], 'segment': 'gamma.vob', 'tags': {
+                    'date': {'99'}, 'red': {None},
+                }},
+                {'fid': self.fids[1], 'segment': 'loog.txt', 'tags': {
+                    'date': {'98'}, 'red': {None},
+                }},
+                {'fid': self.fids[2], 'segment': 'noxx', 'tags': {
+                    'date': {'103'},
+                }},
+            ],
+        )
+
+    def test_query_paths(self):
+        self.assertEqual(
+            self.query.query_paths(self.fids[1:]),
+            {
+                self.fids[1]: '/home/hebwy/loog.txt',
+                self.fids[2]: '/home/hebwy/noxx',
+            },
+        )
+
+    def test_query_paths_many(self):
+        limit = self.query.conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        self.query.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        try:
+            paths = self.query.query_paths(
+                self.fids[1:] + list(range(10000, 12000))
+            )
+        finally:
+            self.query.conn.setlimit(
+                sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit,
+            )
+        self.assertEqual(sorted(paths), sorted(self.fids[1:]))
+
     def test_query_path(self):
         self.assertEqual(
             self.query.query_path(self.fids[1]),
@@ -154,6 +574,33 @@ class TestQueryDB(unittest.TestCase):
             ],
         )
 
+    def test_query_tags_batched(self):
+        self.assertEqual(
+            list(self.query.query_tags('prefix', 'date=', batch_size=2)),
+            [
+                'date=103',
+                'date=98', 
+                'date=99', 
+            ],
+        )
+
+    def test_query_tags_prefix_plan(self):
+        statements = []
+        self.query.conn.set_trace_callback(statements.append)
+        try:
+            list(self.query.query_tags('prefix', 'date='))
+        finally:
+            self.query.conn.set_trace_callback(None)
+        self.assertEqual(len(statements), 1)
+        plan = [
+            row[-1] for row in
+            db.execute('EXPLAIN QUERY PLAN ' + statements[0]).fetchall()
+        ]
+        self.assertTrue(
+            any('tag_names_tag_nocase' in step for step in plan), plan,
+        )
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
     def test_query_tags_anywhere(self):
         self.assertEqual(
             list(self.query.query_tags('anywhere', 'r')),
@@ -163,6 +610,376 @@ class TestQueryDB(unittest.TestCase):
             ],
         )
 
+    def test_query_tags_anywhere_batched(self):
+        statements = []
+        self.query.conn.set_trace_callback(statements.append)
+        try:
+            tags = list(self.query.query_tags('anywhere', 'e', batch_size=1))
+        finally:
+            self.query.conn.set_trace_callback(None)
+        self.assertEqual(tags, list(self.query.query_tags('anywhere', 'e')))
+        self.assertGreater(len(tags), 1)
+        # FTS5's own statements are traced as comments
+        self.assertEqual(
+            [
+                statement for statement in statements
+                if not statement.startswith('--')
+            ],
+            statements[:1],
+        )
+
+    def test_query_tags_anywhere_index(self):
+        self.assertTrue(self.query.tag_search)
+        polytaxis_monitor.main.add_tags(self.fids[0], {'purple': {None}})
+        polytaxis_monitor.main.remove_tags(self.fids[2])
+        polytaxis_monitor.main.prune_tags()
+        self.assertEqual(
+            db.execute(
+                'SELECT tag FROM tag_names_fts WHERE tag LIKE \'%urp%\''
+            ).fetchall(),
+            [('purple',)],
+        )
+        self.assertEqual(
+            db.execute(
+                'SELECT tag FROM tag_names_fts WHERE tag LIKE \'%nde%\''
+            ).fetchall(),
+            [],
+        )
+        for tag_search in (True, False):
+            self.query.tag_search = tag_search
+            for arg in ('ur', 'URP'):
+                self.assertEqual(
+                    list(self.query.query_tags('anywhere', arg)),
+                    ['purple'],
+                )
+
+    def test_query_tags_counts(self):
+        self.assertEqual(
+            list(self.query.query_tags('prefix', 'date', counts=True)),
+            [('date=103', 1), ('date=98', 1), ('date=99', 1)],
+        )
+        self.assertEqual(
+            list(self.query.query_tags('prefix', 'se', counts=True)),
+            [('seven', 3)],
+        )
+        polytaxis_monitor.main.remove_tags(self.fids[0])
+        polytaxis_monitor.main.update_tags(
+            self.fids[1], self.tag_sets[1], {'seven': {None}},
+        )
+        self.assertEqual(
+            list(self.query.query_tags('prefix', 'se', counts=True)),
+            [('seven', 2)],
+        )
+        self.assertEqual(list(self.query.query_tags('prefix', 'red')), [])
+
+    def test_facets(self):
+        self.assertEqual(
+            self.query.facets('seven'),
+            [(None, 3)],
+        )
+        self.assertEqual(
+            self.query.facets('date', ['red']),
+            [('98', 1), ('99', 1)],
+        )
+        self.assertEqual(
+            self.query.facets('date', [], ['juicy']),
+            [('98', 1), ('103', 1)],
+        )
+        self.assertEqual(
+            self.query.facets(
+                'date', ['seven'], filters={(operator.gt, 'date', '98')},
+            ),
+            [('99', 1), ('103', 1)],
+        )
+
+    def test_explain(self):
+        plan = self.query.explain(
+            ['seven', 'juicy', 'date=%'],
+            ['under', 'red'],
+            filters={(operator.ge, 'date', '99')},
+        )
+        self.assertEqual(
+            [row for row in plan if row[0] != 'sqlite'],
+            [
+                ('scan', 'juicy', 1, 1),
+                ('probe', 'date>=99', 2, 2),
+                ('probe', 'seven', 3, 3),
+                ('exclude', 'red', 2, 2),
+                ('exclude', 'under', 1, 1),
+                ('result', '', 1, 0),
+            ],
+        )
+        self.assertTrue(any(row[0] == 'sqlite' for row in plan))
+
+    def test_search_top_ascending(self):
+        rows = polytaxis_monitor.server.search(
+            self.query, ['sort+:date', 'seven'], 2, add_path=True,
+        )
+        self.assertEqual(
+            [(row.path, row['tags']['date']) for row in rows],
+            [('/home/hebwy/loog.txt', {'98'}), ('/what/you/at/gamma.vob', {'99'})],
+        )
+
+    def test_query_missing_tag(self):
+        self.assertEqual(list(self.query.query(['seven', 'nothing'], [])), [])
+
+    def test_query_cache(self):
+        first = list(self.query.query(['red'], []))
+        self.assertEqual(list(self.query.query(['red'], [])), first)
+        self.assertEqual(self.query.hits, 1)
+        # Partially read results aren't cached
+        next(self.query.query(['seven'], []))
+        list(self.query.query(['seven'], []))
+        self.assertEqual(self.query.hits, 1)
+        polytaxis_monitor.main.add_tags(self.fids[2], {'red': {None}})
+        self.assertEqual(len(list(self.query.query(['red'], []))), 3)
+        self.assertEqual(self.query.hits, 1)
+        self.query.result_cache_size = 1
+        list(self.query.query(['juicy'], []))
+        self.assertEqual(self.query.cache_stats()['entries'], 1)
+
+    def test_query_cache_copies(self):
+        for row in self.query.query(['juicy'], [], columns=['date']):
+            row['tags']['date'].add('1')
+        rows = list(self.query.query(['juicy'], [], columns=['date']))
+        self.assertEqual(self.query.hits, 1)
+        self.assertEqual(rows[0]['tags']['date'], {'99'})
+
+    def test_query_cache_other_writer(self):
+        with tempfile.TemporaryDirectory() as root:
+            db_path = os.path.join(root, 'db.sqlite3')
+            # The SQLite cache_size option must still reach open_db
+            query = polytaxis_monitor.common.QueryDB(
+                db_path=db_path, cache_size=-1000,
+            )
+            self.assertEqual(
+                query.cursor.execute('PRAGMA cache_size').fetchone()[0],
+                -1000,
+            )
+            writer = sqlite3.connect(db_path)
+            self.assertEqual(list(query.query(['a'], [])), [])
+            self.assertEqual(list(query.query(['a'], [])), [])
+            self.assertEqual(query.hits, 1)
+            writer.execute(
+                'INSERT INTO files (id, parent, segment, tags) '
+                'VALUES (1, NULL, \'x\', \'a\n\')'
+            )
+            writer.execute(
+                'INSERT INTO tag_names (id, tag, key) VALUES (1, \'a\', \'a\')'
+            )
+            writer.execute('INSERT INTO file_tags (tag, file) VALUES (1, 1)')
+            writer.commit()
+            self.assertEqual(
+                [row['fid'] for row in query.query(['a'], [])],
+                [1],
+            )
+            self.assertEqual(query.cache_stats()['hits'], 1)
+            writer.close()
+            query.conn.close()
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        db.execute('DELETE FROM file_tags')
+        db.execute('DELETE FROM tag_names')
+        db.execute('DELETE FROM files')
+        db.execute('DELETE FROM paths')
+        polytaxis_monitor.main.segments.clear()
+        self.fids = []
+        for index in range(5):
+            tags = {'n': {str(index)}, 'odd': {str(index % 2)}}
+            fid = polytaxis_monitor.main.create_file(
+                '/music/{}.flac'.format(index), tags,
+            )
+            polytaxis_monitor.main.add_tags(fid, tags)
+            self.fids.append(fid)
+
+    def test_search(self):
+        with tempfile.TemporaryDirectory() as root, patch(
+                'polytaxis_monitor.common.open_db',
+                new=lambda: (db, db_cursor),
+                ):
+            path = os.path.join(root, 'query.sock')
+            server = polytaxis_monitor.server.QueryServer(path)
+            server.start()
+            client = polytaxis_monitor.client.Client(path)
+            try:
+                rows = list(client.call(
+                    'search', args=['odd=1', 'sort-:n'], limit=5,
+                    add_path=True,
+                ))
+                self.assertEqual(
+                    [row['tags']['path'] for row in rows],
+                    [{'/music/3.flac'}, {'/music/1.flac'}],
+                )
+                self.assertEqual(
+                    rows[0]['tags']['n'],
+                    {'3'},
+                )
+                rows = list(client.call(
+                    'search', args=['odd=1', 'sort-:n'], limit=5,
+                    add_path=True, project=True,
+                ))
+                self.assertEqual(
+                    [(row.path, row['tags']) for row in rows],
+                    [
+                        ('/music/3.flac', {
+                            'n': {'3'}, 'path': {'/music/3.flac'},
+                        }),
+                        ('/music/1.flac', {
+                            'n': {'1'}, 'path': {'/music/1.flac'},
+                        }),
+                    ],
+                )
+                # The connection is reused for later requests
+                self.assertEqual(
+                    list(client.call('facets', key='odd', args=[], limit=5)),
+                    [['0', 3], ['1', 2]],
+                )
+                self.assertEqual(
+                    dict(client.call('query_paths', fids=self.fids[:1])),
+                    {self.fids[0]: '/music/0.flac'},
+                )
+                local = list(polytaxis_monitor.server.methods['query_tags'](
+                    polytaxis_monitor.common.QueryDB(),
+                    method='prefix', arg='odd', limit=5, counts=True,
+                ))
+                self.assertEqual(local, [('odd=0', 3), ('odd=1', 2)])
+                self.assertEqual(
+                    list(client.call(
+                        'query_tags', method='prefix', arg='odd', limit=5,
+                        counts=True,
+                    )),
+                    [list(row) for row in local],
+                )
+                with self.assertRaises(polytaxis_monitor.client.ServerError):
+                    list(client.call('missing'))
+            finally:
+                client.close()
+                server.stop()
+            self.assertFalse(os.path.exists(path))
+
+    def test_client_disconnect(self):
+        def flood(db):
+            return ('x' * 1000 for index in range(10000))
+
+        with tempfile.TemporaryDirectory() as root, patch.dict(
+                polytaxis_monitor.server.methods, flood=flood,
+                ):
+            path = os.path.join(root, 'query.sock')
+            server = polytaxis_monitor.server.QueryServer(path)
+            server.start()
+            try:
+                with patch.object(server, 'handle_error') as handle_error:
+                    client = polytaxis_monitor.client.Client(path)
+                    next(client.call('flood'))
+                    client.close()
+                    client = polytaxis_monitor.client.Client(path)
+                    self.assertEqual(len(list(client.call('flood'))), 10000)
+                    client.close()
+                self.assertFalse(handle_error.called)
+            finally:
+                server.stop()
+
+    def test_thin_client(self):
+        # ptq --server shouldn't pay for importing the query code
+        modules = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import sys, ptq.main, polytaxis_monitor.client; '
+                'print(" ".join(sys.modules))',
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout.split()
+        for module in ('polytaxis_monitor.common', 'natsort', 'polytaxis'):
+            self.assertNotIn(module, modules)
+
+class TestSchema(unittest.TestCase):
+    def test_migrate_unversioned(self):
+        old_db = sqlite3.connect(':memory:')
+        old_db.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, parent INT, segment TEXT NOT NULL, tags TEXT)')
+        old_db.execute('CREATE TABLE tags (tag TEXT NOT NULL, file INT NOT NULL)')
+        old_db.executemany(
+            'INSERT INTO files (id, parent, segment, tags) VALUES (?, ?, ?, ?)',
+            [
+                (1, None, '/', None),
+                (2, 1, 'home', None),
+                (3, 2, 'loog.txt', 'a=b\n'),
+            ],
+        )
+        old_db.execute('INSERT INTO tags (tag, file) VALUES (\'a=b\', 3)')
+        polytaxis_monitor.common.migrate_db(old_db)
+        self.assertEqual(
+            old_db.execute(
+                'SELECT tag_names.tag, file_tags.file FROM file_tags '
+                'JOIN tag_names ON tag_names.id = file_tags.tag'
+            ).fetchall(),
+            [('a=b', 3)],
+        )
+        self.assertEqual(
+            old_db.execute('SELECT key, value, count FROM tag_names').fetchall(),
+            [('a', 'b', 1)],
+        )
+        self.assertEqual(
+            old_db.execute('SELECT * FROM paths ORDER BY file').fetchall(),
+            [(1, '/'), (2, '/home'), (3, '/home/loog.txt')],
+        )
+        self.assertEqual(
+            polytaxis_monitor.common.schema_version(old_db),
+            len(polytaxis_monitor.common.migrations),
+        )
+        self.assertCountEqual(
+            [
+                name for (name,) in old_db.execute(
+                    'SELECT name FROM sqlite_master WHERE type = \'index\''
+                )
+            ],
+            [
+                'files_parent_segment',
+                'paths_path',
+                'sqlite_autoindex_tag_names_1',
+                'file_tags_file',
+                'tag_names_key_sort',
+                'tag_names_tag_nocase',
+            ],
+        )
+
+    def test_migrate_interrupted(self):
+        def broken(cursor):
+            polytaxis_monitor.common._migrate_paths(cursor)
+            raise RuntimeError('interrupted')
+
+        migrations = list(polytaxis_monitor.common.migrations)
+        migrations[1] = broken
+        with tempfile.TemporaryDirectory() as root:
+            db_path = os.path.join(root, 'db.sqlite3')
+            old_db = sqlite3.connect(db_path)
+            old_db.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, parent INT, segment TEXT NOT NULL, tags TEXT)')
+            old_db.execute('CREATE TABLE tags (tag TEXT NOT NULL, file INT NOT NULL)')
+            with patch('polytaxis_monitor.common.migrations', new=migrations):
+                with self.assertRaises(RuntimeError):
+                    polytaxis_monitor.common.migrate_db(old_db)
+            old_db.close()
+            old_db = sqlite3.connect(db_path)
+            self.assertEqual(polytaxis_monitor.common.schema_version(old_db), 1)
+            self.assertFalse(polytaxis_monitor.common.has_table(old_db, 'paths'))
+            old_db.close()
+            conn, cursor = polytaxis_monitor.common.open_db(db_path=db_path)
+            self.assertEqual(
+                polytaxis_monitor.common.schema_version(cursor),
+                len(polytaxis_monitor.common.migrations),
+            )
+            conn.close()
+
+    def test_migrate_current(self):
+        version = polytaxis_monitor.common.schema_version(db)
+        polytaxis_monitor.common.migrate_db(db)
+        self.assertEqual(
+            polytaxis_monitor.common.schema_version(db),
+            version,
+        )
+
 class TestCommon(unittest.TestCase):
     def test_parse_args(self):
         includes, excludes, filters, sort, columns = (
@@ -223,6 +1040,58 @@ class TestCommon(unittest.TestCase):
             ],
         )
     
+    def test_sort_keys_once(self):
+        rows = [
+            {'fid': index, 'segment': str(index), 'tags': {'1': {str(index % 7)}}}
+            for index in range(50)
+        ]
+        natkey = polytaxis_monitor.common._natkey
+        calls = []
+        def count(value):
+            calls.append(value)
+            return natkey(value)
+        with patch('polytaxis_monitor.common._natkey', new=count):
+            got = polytaxis_monitor.common.sort([('desc', '1')], rows)
+        self.assertEqual(len(calls), len(rows))
+        self.assertEqual(
+            [row['tags']['1'] for row in got],
+            [{str(index)} for index in range(6, -1, -1) for _ in range(
+                len(range(index, 50, 7))
+            )],
+        )
+
+    def test_top(self):
+        rows = [
+            {'fid': index, 'segment': str(index), 'tags': {
+                '1': {str(index % 3)}, '2': {str(index)},
+            }}
+            for index in range(30)
+        ]
+        sort_info = [('asc', '1'), ('desc', '2')]
+        self.assertEqual(
+            polytaxis_monitor.common.top(sort_info, iter(rows), 4),
+            polytaxis_monitor.common.sort(sort_info, rows)[:4],
+        )
+
+    def test_sort_mixed(self):
+        rows = [
+            {'fid': index, 'segment': str(index), 'tags': {
+                '1': {str(index % 3)}, '2': {str(index)},
+            }}
+            for index in range(9)
+        ]
+        for terms, expected in (
+                (['sort+:1', 'sort-:2'], [6, 3, 0, 7, 4, 1, 8, 5, 2]),
+                (['sort-:1', 'sort+:2'], [2, 5, 8, 1, 4, 7, 0, 3, 6]),
+                ):
+            sort_info = polytaxis_monitor.common.parse_query(terms)[3]
+            got = polytaxis_monitor.common.sort(sort_info, rows)
+            self.assertEqual([row['fid'] for row in got], expected)
+            self.assertEqual(
+                polytaxis_monitor.common.top(sort_info, iter(rows), 4),
+                got[:4],
+            )
+
     def test_sort_missing(self):
         rows = [
             {'fid': 0, 'segment': '0', 'tags': {'2': {'a'}}},
@@ -253,6 +1122,13 @@ class TestCommon(unittest.TestCase):
             ],
         )
 
+    def test_natural_sort_key(self):
+        values = ['', '0', '01', '2', '10', 'a', 'a2', 'a10', 'ab', '12abc']
+        self.assertEqual(
+            sorted(values, key=polytaxis_monitor.common.natural_sort_key),
+            sorted(values, key=polytaxis_monitor.common._natkey),
+        )
+
     def test_filter(self):
         rows = [
             {'fid': 0, 'segment': '0', 'tags': {'a': {'1'}}},
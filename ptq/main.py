@@ -2,23 +2,34 @@ import argparse
 import sys
 import os
 import signal
+import threading
 
-import appdirs
+import polytaxis_monitor.client
+import polytaxis_monitor.options
 
-import polytaxis_monitor.common
-import polytaxis_monitor.main
 
-def limit(maxcount, generator):
-    count = 0
-    for x in generator:
-        if count >= maxcount:
-            break
-        count += 1
-        yield x
+def load_common(args):
+    # common pulls in natsort and polytaxis, so only import it on paths that
+    # open the database and keep forward --server a thin client
+    import polytaxis_monitor.common
+    if args.verbose or args.super_verbose:
+        polytaxis_monitor.common.verbose = True
+    return polytaxis_monitor.common
 
 
 def reverse(args):
-    conn, cursor = polytaxis_monitor.common.open_db()  
+    # The monitor pulls in watchdog, which forward queries don't need
+    import polytaxis_monitor.main
+    common = load_common(args)
+
+    if args.verbose or args.super_verbose:
+        setattr(polytaxis_monitor.main, 'verbose', True)
+    if args.super_verbose:
+        setattr(polytaxis_monitor.main, 'super_verbose', True)
+
+    conn, cursor = common.open_db(
+        **polytaxis_monitor.options.db_options(args)
+    )
     setattr(polytaxis_monitor.main, 'conn', conn)
     setattr(polytaxis_monitor.main, 'cursor', cursor)
 
@@ -35,72 +46,176 @@ def reverse(args):
             print('id: {}'.format(fid))
             print('raw_tags: {}'.format(repr(raw_tags)))
             print('tag entries: {}'.format(
-                cursor.execute('SELECT * FROM tags WHERE file = :fid', {'fid': fid}).fetchall()
+                cursor.execute(
+                    'SELECT tag_names.tag, file_tags.file FROM file_tags '
+                    'JOIN tag_names ON tag_names.id = file_tags.tag '
+                    'WHERE file_tags.file = :fid',
+                    {'fid': fid},
+                ).fetchall()
             ))
             print('')
     return 0
 
 
+class Output(object):
+    '''
+    Write results to stdout through a large buffer.  A background thread
+    flushes whatever is buffered every interval seconds (and results are
+    flushed as they're written on a terminal) so readers get results even
+    while the query stalls between them.
+    '''
+    def __init__(self, separator, interval=0.1, buffer_size=1 << 16):
+        sys.stdout.flush()
+        self.file = open(
+            sys.stdout.fileno(), 'wb', buffering=buffer_size, closefd=False,
+        )
+        self.separator = separator
+        self.interval = 0 if sys.stdout.isatty() else interval
+        self.lock = threading.Lock()
+        self.pending = False
+        self.closed = threading.Event()
+        self.flusher = None
+        if self.interval:
+            self.flusher = threading.Thread(target=self._flush, daemon=True)
+            self.flusher.start()
+
+    def _flush(self):
+        while not self.closed.wait(self.interval):
+            with self.lock:
+                if self.pending:
+                    self.file.flush()
+                    self.pending = False
+
+    def write(self, text):
+        # Paths may contain undecodable bytes, which fsencode restores
+        data = os.fsencode(text) + self.separator
+        with self.lock:
+            self.file.write(data)
+            if self.interval:
+                self.pending = True
+            else:
+                self.file.flush()
+
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.file.flush()
+
+
+def serve(args):
+    # A client hanging up mid-response shouldn't take the server down
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    load_common(args)
+    import polytaxis_monitor.server
+    server = polytaxis_monitor.server.QueryServer(
+        args.socket,
+        **polytaxis_monitor.options.db_options(args)
+    )
+    if args.verbose:
+        print('Serving queries at [{}]'.format(server.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(server.path)
+    return 0
+
+
 def forward(args):
     if args.unwrap:
+        import appdirs
         unwrap_root = os.path.join(
             appdirs.user_data_dir('polytaxis-unwrap', 'zarbosoft'),
             'mount',
         )
 
-    db = polytaxis_monitor.common.QueryDB()
+    if args.server:
+        path = args.socket or polytaxis_monitor.client.default_socket_path()
+        try:
+            call = polytaxis_monitor.client.Client(path).call
+        except (FileNotFoundError, ConnectionRefusedError):
+            sys.stderr.write(
+                'No query server is running at [{}]; start one with '
+                'ptq serve.\n'.format(path)
+            )
+            return 1
+    else:
+        common = load_common(args)
+        from polytaxis_monitor import server
+        db = common.QueryDB(**polytaxis_monitor.options.db_options(args))
+        def call(name, /, **params):
+            return server.methods[name](db, **params)
 
     if args.tags:
         if len(args.args) > 1:
             parser.error(
                 'When querying tags you may specify at most one query argument.'
             )
-        rows = [
-            row for row in limit(
-                args.limit, db.query_tags(
-                    args.tags, 
-                    args.args[0] if args.args else ''
-                )
-            )
-        ]
+        rows = list(call(
+            'query_tags',
+            method=args.tags,
+            arg=args.args[0] if args.args else '',
+            limit=args.limit,
+        ))
         for row in rows:
             print(row)
+        results = len(rows)
+    elif args.explain:
+        rows = list(call('explain', args=args.args))
+        print('{:<8} {:<32} {:>10} {:>10}'.format(
+            'step', 'term', 'estimate', 'actual',
+        ))
+        for step, term, estimate, actual in rows:
+            if step == 'sqlite':
+                print('{:<8} {}'.format(step, term))
+                continue
+            print('{:<8} {:<32} {:>10} {:>10}'.format(
+                step, term, '?' if estimate is None else estimate, actual,
+            ))
+        results = len(rows)
+    elif args.facets:
+        rows = list(call(
+            'facets', key=args.facets, args=args.args, limit=args.limit,
+        ))
+        for value, count in rows:
+            print('{}\t{}'.format(count, '' if value is None else value))
+        results = len(rows)
     else:
-        includes, excludes, filters, sort, columns = (
-            polytaxis_monitor.common.parse_query(args.args)
+        if args.columns:
+            columns = list(call('columns', args=args.args))
+        # Without sort terms rows arrive as the query produces them, so
+        # write each one out immediately rather than collecting them first
+        rows = call(
+            'search',
+            args=args.args,
+            limit=args.limit,
+            add_path=not args.columns,
+            project=True,
         )
-        rows = list(limit(
-            args.limit, 
-            polytaxis_monitor.common.filter(
-                filters,
-                db.query(includes, excludes),
-            ),
-        ))
-        rows = polytaxis_monitor.common.sort(sort, rows)
-        for row in rows:
-            if args.columns:
-                text = '\t'.join(
-                    ','.join(list(row['tags'].get(column, []))) 
-                    for column in columns
-                )
-                if args.print0:
-                    sys.stdout.write(path)
-                    sys.stdout.write('\x00')
+        out = Output(b'\x00' if args.print0 else b'\n')
+        results = 0
+        try:
+            for row in rows:
+                results += 1
+                if args.columns:
+                    out.write('\t'.join(
+                        ','.join(list(row['tags'].get(column, [])))
+                        for column in columns
+                    ))
                 else:
-                    print(text)
-            else:
-                path = db.query_path(row['fid'])
-                if len(path) >= 2 and path[1] == ':':
-                    path = path[2:]
-                if args.unwrap:
-                    path = path[1:]
-                    path = os.path.join(unwrap_root, path)
-                if args.print0:
-                    sys.stdout.write(path)
-                    sys.stdout.write('\x00')
-                else:
-                    print(path)
-    if not args.print0 and len(rows) == args.limit:
+                    path = row.path
+                    if len(path) >= 2 and path[1] == ':':
+                        path = path[2:]
+                    if args.unwrap:
+                        path = path[1:]
+                        path = os.path.join(unwrap_root, path)
+                    out.write(path)
+        finally:
+            out.close()
+    if not args.print0 and results == args.limit:
         sys.stderr.write('Stoped at {} results.\n'.format(args.limit))
 
 
@@ -109,7 +224,7 @@ def main():
 
     if (
             not any(key in sys.argv for key in ('-h', '--help')) and
-            len(sys.argv) < 2 or sys.argv[1] not in ('forward', 'reverse')
+            len(sys.argv) < 2 or sys.argv[1] not in ('forward', 'reverse', 'serve')
             ):
         sys.argv.insert(1, 'forward')
 
@@ -132,13 +247,14 @@ def main():
             action='store_true',
             help='Enable very verbose output.',
         )
+        polytaxis_monitor.options.add_db_arguments(out)
         return out
 
     query_command = add_common_subparser('forward', description='Query the database.')
     query_command.add_argument(
         'args',
         help='Query argument(s).',
-        nargs='+',
+        nargs='*',
         default=[],
     )
     query_command.add_argument(
@@ -149,6 +265,28 @@ def main():
         nargs='?',
         const='prefix',
     )
+    query_command.add_argument(
+        '-s',
+        '--server',
+        help='Send the query to a running query server (see serve) instead of opening the database.',
+        action='store_true',
+    )
+    query_command.add_argument(
+        '--socket',
+        help='Query server socket path. Defaults to one in the data directory.',
+    )
+    query_command.add_argument(
+        '-f',
+        '--facets',
+        help='Count the values of this key among the matching files.',
+        metavar='KEY',
+    )
+    query_command.add_argument(
+        '-e',
+        '--explain',
+        help='Print the query plan with estimated and actual file counts instead of results.',
+        action='store_true',
+    )
     query_command.add_argument(
         '-n',
         '--limit',
@@ -189,16 +327,21 @@ def main():
         action='store_true',
     )
 
-    args = parser.parse_args()
+    serve_command = add_common_subparser(
+        'serve',
+        description='Serve queries on a Unix socket for forward --server.',
+    )
+    serve_command.add_argument(
+        '--socket',
+        help='Socket path. Defaults to one in the data directory.',
+    )
 
-    if args.verbose or args.super_verbose:
-        polytaxis_monitor.common.verbose = True
-        setattr(polytaxis_monitor.main, 'verbose', True)
-    if args.super_verbose:
-        setattr(polytaxis_monitor.main, 'super_verbose', True)
+    args = parser.parse_args()
 
     if args.command == 'reverse':
         return reverse(args)
+    elif args.command == 'serve':
+        return serve(args)
     else:
         return forward(args)
 